@@ -0,0 +1,1180 @@
+import argparse
+import base64
+import hashlib
+import json
+import multiprocessing
+import os
+import platform
+import re
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+from datetime import date
+from datetime import datetime, timedelta
+from email import message_from_bytes
+from functools import partial
+from http.server import BaseHTTPRequestHandler, SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import mongomock
+import numpy as np
+import pandas as pd
+import psutil
+import pymongo
+from office365.sharepoint.client_context import ClientContext
+
+import update_db
+
+
+# Benchmarks for the update_db pipeline stages. Run with:
+#   python benchmark.py [--full]
+# --full also times the original per-terminal loops at the largest sizes,
+# which can take a very long time.
+
+
+# Settings for the stages under benchmark, so no credentials.json is needed. Remote
+# endpoints are replaced by local stand-ins in each benchmark.
+BENCH_DIR = os.path.join(tempfile.gettempdir(), 'rca_benchmark')
+BENCH_CONFIG = {
+    'directories': {
+        'RAW_DB': '', 'LEG_DB': '', 'SHA_DB': '', 'LEG_SHA': '',
+        'RAW_RCA_LOC': os.path.join(BENCH_DIR, 'raw_rca') + os.sep,
+        'PROCESSED_RCA_LOC': os.path.join(BENCH_DIR, 'processed_rca') + os.sep,
+        'LOCAL_DB': os.path.join(BENCH_DIR, 'local.db'),
+        'LEGACY_DB': os.path.join(BENCH_DIR, 'legacy.db'),
+        'WORKSPACE_DIR': os.path.join(BENCH_DIR, 'workspace'),
+        'DATE_CACHE_DB': os.path.join(BENCH_DIR, 'latest_dates.db'),
+        'RUN_REPORT': os.path.join(BENCH_DIR, 'run_report.json'),
+        'RUN_STATE': os.path.join(BENCH_DIR, 'run_state.json'),
+    },
+    'sharepoint': {'SITE': 'http://127.0.0.1/sites/NIBSS-ITEXrepo', 'USERNAME': '', 'PASSWORD': ''},
+    'github': {'USERNAME': 'bench', 'REPOSITORY': 'rca', 'TOKEN': 'bench', 'PATH': 'rca.db', 'LEG_PATH': 'legacy.db'},
+    'mongodb': {'HOST': 'localhost', 'PORT': 27017, 'USERNAME': 'bench', 'PASSWORD': 'bench', 'DATABASE': 'eftEngine'},
+}
+update_db.apply_config(BENCH_CONFIG)
+
+
+# Modules update_db must not load when it is imported
+HEAVY_MODULES = ['pandas', 'numpy', 'pymongo', 'office365', 'psutil', 'requests', 'openpyxl', 'pyarrow']
+
+
+# xlsx sheets hold at most 1,048,576 rows including the header
+XLSX_MAX_ROWS = 1_048_575
+
+
+# Column layout of the 'REGISTERED TERMINALS' sheet in the NIBSS RCA file
+REGISTERED_COLUMNS = [
+    'Terminal_ID', 'Merchant_ID', 'Merchant_Name', 'Bank', 'MCC', 'ptsp_code', 'PTSP',
+    'Merchant_Account_No', 'AccountNo', 'Registered_Date', 'ConnectDate', 'Contact',
+    'Address', 'Phone', 'State', 'Terminal_Owner', 'LastSeenDate',
+]
+
+
+def make_terminal_ids(n, offset=0):
+    # Alphanumeric terminal IDs, so spreadsheet readers keep them as text
+    return pd.Series([f'2ITX{i + offset:07d}' for i in range(n)])
+
+
+def make_rca_frames(n, connected_share=0.7, active_share=0.5, seed=0):
+    # Synthetic REGISTERED TERMINALS / CONNECTED TERMINALS sheets and VAS latest dates
+    rng = np.random.default_rng(seed)
+    tids = make_terminal_ids(n)
+    last_seen = pd.Timestamp('2023-06-01') + pd.to_timedelta(rng.integers(0, 180, n), unit='D')
+    reg_df = pd.DataFrame({
+        'Terminal_ID': tids,
+        'Merchant_ID': [f'2033LA{i:09d}' for i in range(n)],
+        'Merchant_Name': [f'MERCHANT {i % 5000}' for i in range(n)],
+        'Bank': rng.choice(['ACCESS', 'GTB', 'UBA', 'ZENITH', 'FIRST'], n),
+        'MCC': rng.integers(1000, 9999, n),
+        'ptsp_code': 'ITX',
+        'PTSP': 'ITEX',
+        'Merchant_Account_No': rng.integers(10**9, 10**10, n).astype(str),
+        'AccountNo': rng.integers(10**9, 10**10, n).astype(str),
+        'Registered_Date': last_seen - pd.Timedelta(days=365),
+        'ConnectDate': last_seen - pd.Timedelta(days=300),
+        'Contact': 'CONTACT',
+        'Address': 'ADDRESS',
+        'Phone': '08000000000',
+        'State': rng.choice(['LAGOS', 'ABUJA', 'RIVERS', 'OYO'], n),
+        'Terminal_Owner': rng.choice(['ITEX', 'BANK', 'AGGREGATOR'], n),
+        'LastSeenDate': last_seen,
+    }, columns=REGISTERED_COLUMNS)
+    connected_df = pd.DataFrame({'Terminal_ID': tids[rng.random(n) < connected_share].values})
+    active = tids[rng.random(n) < active_share].values
+    latest_date_df = pd.DataFrame({
+        'latest_date': pd.Timestamp('2024-01-01') + pd.to_timedelta(rng.integers(0, 30, len(active)), unit='D'),
+        'terminalId': active,
+    })
+    return reg_df, connected_df, latest_date_df
+
+
+def loop_upsert_legacy_dates(leg_df, cur_df, today_date):
+    # The original update_legacy() loop, kept here as the baseline
+    for tid in cur_df['Terminal_ID']:
+        if tid in leg_df['Terminal_ID'].values:
+            leg_df.loc[leg_df['Terminal_ID'] == tid, 'LAST_TRANSACTION_DATE'] = today_date
+        else:
+            new_row = pd.DataFrame({'Terminal_ID': [tid], 'LAST_TRANSACTION_DATE': [today_date]})
+            leg_df = pd.concat([leg_df, new_row], ignore_index=True)
+    return leg_df
+
+
+def loop_classify_terminals(reg_df, connected_df, latest_date_df):
+    # The original transform_file() classification, kept here as the baseline
+    reg_df = reg_df.copy()
+    reg_df['CONNECTED'] = reg_df['Terminal_ID'].apply(
+        lambda tid: 'YES' if tid in connected_df['Terminal_ID'].values else 'NO'
+    )
+    reg_df['STATUS'] = reg_df['Terminal_ID'].apply(
+        lambda stat: 'ACTIVE' if stat in latest_date_df['terminalId'].values else 'INACTIVE'
+    )
+    reg_df = reg_df.merge(latest_date_df, left_on='Terminal_ID', right_on='terminalId', how='left')
+    reg_df.rename(columns={'LastSeenDate': 'LAST_TRANSACTION_DATE'}, inplace=True)
+    reg_df['LAST_TRANSACTION_DATE'] = reg_df['latest_date'].combine_first(reg_df['LAST_TRANSACTION_DATE'])
+    reg_df.drop('latest_date', axis=1, inplace=True)
+    return reg_df
+
+
+def make_rca_workbook(path, n):
+    # Raw RCA workbook with both sheets, written row by row to keep generation memory flat
+    reg_df, connected_df, _ = make_rca_frames(n)
+    with pd.ExcelWriter(path, engine='xlsxwriter', engine_kwargs={'options': {'constant_memory': True}}) as writer:
+        reg_df.to_excel(writer, sheet_name='REGISTERED TERMINALS', index=False)
+        connected_df.to_excel(writer, sheet_name='CONNECTED TERMINALS', index=False)
+    return path
+
+
+def make_rca_database(path, n):
+    # SQLite database shaped like the published RCA_table
+    reg_df, connected_df, latest_date_df = make_rca_frames(n)
+    reg_df = reg_df[['Terminal_ID', 'Merchant_Name', 'Terminal_Owner', 'LastSeenDate']]
+    df = update_db.classify_terminals(reg_df, connected_df['Terminal_ID'], latest_date_df)
+    conn = sqlite3.connect(path)
+    df.astype(str).to_sql('RCA_table', conn, if_exists='replace', index=False)
+    conn.close()
+    return path
+
+
+def make_legacy_database(path, n, offset=0):
+    # SQLite database shaped like the published legacy dates table
+    conn = sqlite3.connect(path)
+    pd.DataFrame({'Terminal_ID': make_terminal_ids(n, offset), 'LAST_TRANSACTION_DATE': '2023-01-01'}).to_sql(
+        'RCA_table', conn, if_exists='replace', index=False)
+    conn.close()
+    return path
+
+
+class FakeGitHubHandler(BaseHTTPRequestHandler):
+    # Minimal in-memory stand-in for the parts of the GitHub contents and Git Data APIs
+    # the publisher uses. State lives on the server object.
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        if 'chunked' in self.headers.get('Transfer-Encoding', ''):
+            body = bytearray()
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return bytes(body)
+                body += self.rfile.read(size)
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def reply(self, status, payload=None):
+        body = json.dumps(payload or {}).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def head_tree(self):
+        state = self.server.state
+        return state['trees'][state['commits'][state['ref']]['tree']]
+
+    def do_GET(self):
+        state = self.server.state
+        path = self.path.split('?')[0]
+        if re.fullmatch(r'/repos/[^/]+/[^/]+', path):
+            return self.reply(200, {'default_branch': 'main'})
+        match = re.fullmatch(r'/repos/[^/]+/[^/]+/contents/(.+)', path)
+        if match:
+            sha = self.head_tree().get(match.group(1))
+            return self.reply(200, {'sha': sha}) if sha else self.reply(404, {'message': 'Not Found'})
+        if re.fullmatch(r'/repos/[^/]+/[^/]+/git/ref/heads/main', path):
+            return self.reply(200, {'object': {'sha': state['ref']}})
+        match = re.fullmatch(r'/repos/[^/]+/[^/]+/git/commits/(\w+)', path)
+        if match and match.group(1) in state['commits']:
+            return self.reply(200, {'tree': {'sha': state['commits'][match.group(1)]['tree']}})
+        self.reply(404, {'message': 'Not Found'})
+
+    def do_POST(self):
+        state = self.server.state
+        path = self.path.split('?')[0]
+        payload = json.loads(self.read_body())
+        state['requests'] += 1
+        if path.endswith('/git/blobs'):
+            content = base64.b64decode(payload['content'])
+            sha = hashlib.sha1(f'blob {len(content)}\0'.encode() + content).hexdigest()
+            state['blobs'][sha] = content
+            return self.reply(201, {'sha': sha})
+        if path.endswith('/git/trees'):
+            tree = dict(state['trees'][payload['base_tree']])
+            tree.update({entry['path']: entry['sha'] for entry in payload['tree']})
+            sha = hashlib.sha1(json.dumps(tree, sort_keys=True).encode()).hexdigest()
+            state['trees'][sha] = tree
+            return self.reply(201, {'sha': sha})
+        if path.endswith('/git/commits'):
+            sha = hashlib.sha1(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+            state['commits'][sha] = {'tree': payload['tree'], 'parents': payload['parents']}
+            return self.reply(201, {'sha': sha})
+        self.reply(404, {'message': 'Not Found'})
+
+    def do_PATCH(self):
+        state = self.server.state
+        payload = json.loads(self.read_body())
+        state['requests'] += 1
+        state['ref'] = payload['sha']
+        self.reply(200, {'object': {'sha': payload['sha']}})
+
+
+def start_fake_github():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeGitHubHandler)
+    server.state = {
+        'blobs': {}, 'trees': {'t0': {}}, 'commits': {'c0': {'tree': 't0', 'parents': []}},
+        'ref': 'c0', 'requests': 0,
+    }
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+
+class FakeSharePointHandler(BaseHTTPRequestHandler):
+    # Minimal in-memory stand-in for the SharePoint REST endpoints the client layer uses:
+    # folder listing, file download, batched moveto and chunked upload sessions.
+    # Files live on the server object keyed by server-relative URL.
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, payload=None, body=None, content_type='application/json;odata=verbose'):
+        if body is None:
+            body = json.dumps({'d': payload or {}}).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def api_call(self, url):
+        # The part of a request URL after /_api/, unquoted, with path addressing
+        # (getFileByServerRelativePath(DecodedUrl=...)) folded into url addressing,
+        # and files addressed by Id within a folder into url addressing
+        path = urllib.parse.unquote(urllib.parse.urlsplit(url).path)
+        call = path.split('/_api/', 1)[1]
+        call = re.sub(r"(get(?:File|Folder)ByServerRelative)Path\(DecodedUrl=", r"\1Url(", call, flags=re.I)
+        match = re.match(r"web/getFolderByServerRelativeUrl\('.+'\)/Files\('(\w+)'\)", call, re.I)
+        if match:
+            urls = [url for url in self.server.files if self.file_entry(url)['Id'] == match.group(1)]
+            if urls:
+                file_url = urls[0].replace("'", "''")
+                call = f"web/getFileByServerRelativeUrl('{file_url}')" + call[match.end():]
+        return call
+
+    def file_entry(self, url):
+        return {'Name': url.rsplit('/', 1)[1], 'ServerRelativeUrl': url, 'ServerRelativePath': {'DecodedUrl': url},
+                'Id': hashlib.md5(url.encode()).hexdigest(),
+                'ETag': f'"{{{hashlib.md5(self.server.files[url]).hexdigest()}}},1"', 'Length': len(self.server.files[url])}
+
+    def do_GET(self):
+        time.sleep(self.server.delay)
+        self.server.requests += 1
+        call = self.api_call(self.path)
+        match = re.fullmatch(r"web/getFolderByServerRelativeUrl\('(.+)'\)/Files", call, re.I)
+        if match:
+            folder = match.group(1).replace("''", "'") + '/'
+            entries = [self.file_entry(url) for url in sorted(self.server.files)
+                       if url.startswith(folder) and '/' not in url[len(folder):]]
+            return self.reply(200, {'results': entries})
+        match = re.fullmatch(r"web/getFolderByServerRelativeUrl\('(.+)'\)", call, re.I)
+        if match:
+            url = match.group(1).replace("''", "'")
+            return self.reply(200, {'Name': url.rsplit('/', 1)[1], 'ServerRelativeUrl': url})
+        match = re.fullmatch(r"web/getFileByServerRelativeUrl\('(.+)'\)/\$value", call, re.I)
+        if match and match.group(1).replace("''", "'") in self.server.files:
+            return self.reply(200, body=self.server.files[match.group(1).replace("''", "'")],
+                              content_type='application/octet-stream')
+        self.reply(404, {'error': 'Not Found'})
+
+    def do_POST(self):
+        time.sleep(self.server.delay)
+        self.server.requests += 1
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        call = self.api_call(self.path)
+        if call.lower() == 'contextinfo':
+            return self.reply(200, {'GetContextWebInformation': {
+                'FormDigestValue': 'digest', 'FormDigestTimeoutSeconds': 1800}})
+        if call == '$batch':
+            return self.reply_batch(body)
+        if self.headers.get('X-HTTP-Method') == 'DELETE':
+            match = re.fullmatch(r"web/getFileByServerRelativeUrl\('(.+)'\)", call, re.I)
+            if match and self.server.files.pop(match.group(1).replace("''", "'"), None) is not None:
+                return self.reply(200)
+            return self.reply(404, {'error': 'Not Found'})
+        status, payload = self.handle_call(call, body)
+        self.reply(status, payload)
+
+    def reply_batch(self, body):
+        # Run each sub-request of a multipart batch and answer with one part per request
+        message = message_from_bytes(b'Content-Type: ' + self.headers['Content-Type'].encode() + b'\r\n\r\n' + body)
+        parts = []
+        for part in message.walk():
+            if part.get_content_type() != 'application/http':
+                continue
+            request_line = part.get_payload(decode=True).decode().strip().splitlines()[0]
+            url = request_line.split(' ', 1)[1].rsplit(' ', 1)[0]
+            status, payload = self.handle_call(self.api_call(url), b'')
+            reason = 'No Content' if status == 204 else 'OK' if status == 200 else 'Error'
+            parts.append(f'Content-Type: application/http\r\nContent-Transfer-Encoding: binary\r\n\r\n'
+                         f'HTTP/1.1 {status} {reason}\r\nContent-Type: application/json;odata=verbose\r\n\r\n'
+                         f'{json.dumps({"d": payload or {}})}\r\n')
+        boundary = 'batchresponse_fake'
+        response = ''.join(f'--{boundary}\r\n{part}' for part in parts) + f'--{boundary}--\r\n'
+        self.reply(202, body=response.encode(), content_type=f'multipart/mixed; boundary={boundary}')
+
+    @staticmethod
+    def call_params(args):
+        # key=value arguments of an OData function call, string literals unquoted
+        params = {}
+        for key, value in re.findall(r"(\w+)=('(?:[^']|'')*'|[^,]+)", args):
+            params[key.lower()] = value[1:-1].replace("''", "'") if value.startswith("'") else value
+        return params
+
+    def handle_call(self, call, body):
+        files, uploads = self.server.files, self.server.uploads
+        match = re.fullmatch(r"web/getFileByServerRelativeUrl\('(.+)'\)/moveto\((.*)\)", call, re.I)
+        if match:
+            source = match.group(1).replace("''", "'")
+            if source not in files:
+                return 404, {'error': 'Not Found'}
+            files[self.call_params(match.group(2))['newurl']] = files.pop(source)
+            return 204, None
+        match = re.fullmatch(r"web/getFolderByServerRelativeUrl\('(.+)'\)/Files/add\((.*)\)", call, re.I)
+        if match:
+            url = '/'.join([match.group(1).replace("''", "'"), self.call_params(match.group(2))['url']])
+            files[url] = body
+            return 200, self.file_entry(url)
+        match = re.fullmatch(r"web/getFileByServerRelativeUrl\('(.+)'\)/(\w+upload)\((.*)\)", call, re.I)
+        if match:
+            url = match.group(1).replace("''", "'")
+            method = match.group(2).lower()
+            params = self.call_params(match.group(3))
+            upload_id = params['uploadid']
+            if self.server.fail_chunks > 0 and method != 'startupload':
+                self.server.fail_chunks -= 1
+                return 503, {'error': 'Service Unavailable'}
+            if method == 'startupload':
+                uploads[upload_id] = bytearray(body)
+            elif int(params['fileoffset']) != len(uploads[upload_id]):
+                return 400, {'error': 'Offset mismatch'}
+            else:
+                uploads[upload_id] += body
+            if method == 'finishupload':
+                files[url] = bytes(uploads.pop(upload_id))
+                return 200, self.file_entry(url)
+            return 200, {match.group(2)[0].upper() + match.group(2)[1:]: len(uploads[upload_id])}
+        return 404, {'error': 'Not Found'}
+
+
+def start_fake_sharepoint(files=None, delay=0.0):
+    # Returns the server and a ClientContext for it, authenticated with a dummy bearer token
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeSharePointHandler)
+    server.files = dict(files or {})
+    server.uploads = {}
+    server.requests = 0
+    server.delay = delay
+    server.fail_chunks = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    site_url = f'http://127.0.0.1:{server.server_address[1]}/sites/NIBSS-ITEXrepo'
+    ctx = ClientContext(site_url).with_access_token(
+        lambda: {'tokenType': 'Bearer', 'accessToken': 'fake'})
+    return server, ctx
+
+
+def make_journals(terminal_ids, per_terminal=3, days=30, seed=0):
+    # VAS journal documents with an updatedAt inside the aggregation window
+    rng = np.random.default_rng(seed)
+    now = datetime.now()
+    docs = []
+    for tid in terminal_ids:
+        for offset in rng.integers(1, days * 24 * 60, per_terminal):
+            docs.append({'terminalId': tid, 'updatedAt': now - timedelta(minutes=int(offset))})
+    return docs
+
+
+class SlowFileHandler(SimpleHTTPRequestHandler):
+    # Static file server with a fixed per-request latency, standing in for remote hosts
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        time.sleep(self.server.delay)
+        super().do_GET()
+
+
+def start_file_server(directory, delay=0.0):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), partial(SlowFileHandler, directory=directory))
+    server.delay = delay
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+
+def use_mongomock(journals, collection='journals_24_01_03'):
+    # Point update_db at a MongoDB seeded with the given journals: a local mongod when
+    # BENCH_MONGO_URI is set, otherwise an in-memory mongomock
+    if os.environ.get('BENCH_MONGO_URI'):
+        client = pymongo.MongoClient(os.environ['BENCH_MONGO_URI'])
+        client['eftEngine'][collection].drop()
+    else:
+        client = mongomock.MongoClient()
+    if journals:
+        client['eftEngine'][collection].insert_many(journals)
+    update_db._mongo_client = client
+    return client
+
+
+def unnarrowed_recent_date(collection):
+    # The original get_recent_date() aggregation: every terminal, whole result listed
+    today = datetime.now()
+    start = today - timedelta(days=30)
+    pipeline = [
+        {"$match": {"updatedAt": {"$gte": start, "$lt": today}}},
+        {"$group": {"_id": "$terminalId", "latest_date": {"$max": "$updatedAt"}}},
+        {"$project": {"_id": 0, "terminalId": "$_id", "latest_date": 1}},
+    ]
+    return pd.DataFrame(list(collection.aggregate(pipeline)))
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def _timed_with_peak_rss(func, args, interval=0.01):
+    # Sample this process's RSS while func runs; ru_maxrss is not usable here because
+    # Linux carries the parent's high-water mark across fork/exec
+    process = psutil.Process()
+    peak = [process.memory_info().rss]
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(interval):
+            peak[0] = max(peak[0], process.memory_info().rss)
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        _, elapsed = timed(func, *args)
+    finally:
+        done.set()
+        sampler.join()
+    peak[0] = max(peak[0], process.memory_info().rss)
+    return elapsed, peak[0] / 2**20
+
+
+def run_isolated(func, *args):
+    # Run func in a fresh process so its peak RSS is not polluted by earlier runs.
+    # Returns (seconds, peak RSS in MB).
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(_timed_with_peak_rss, (func, args))
+
+
+def download_in_memory(url, path):
+    # The original download_database(): whole body in memory, then written out
+    import requests
+    response = requests.get(url)
+    with open(path, 'wb') as f:
+        f.write(response.content)
+
+
+def read_rca_workbook_full(path):
+    # The original transform_file() read: every sheet, every column
+    return pd.read_excel(path, sheet_name=None)
+
+
+def bench_update_legacy(sizes=(10_000, 100_000, 1_000_000), loop_limit=10_000):
+    # Legacy table holds the whole fleet; the current table overlaps 90% of it and
+    # brings 10% new terminals, which is the usual day-to-day shape.
+    print('update_legacy upsert')
+    print(f"{'terminals':>10} {'vectorized (s)':>15} {'loop (s)':>10}")
+    today_date = date.today()
+    for n in sizes:
+        leg_df = pd.DataFrame({
+            'Terminal_ID': make_terminal_ids(n),
+            'LAST_TRANSACTION_DATE': date(2023, 1, 1),
+        })
+        cur_df = pd.DataFrame({'Terminal_ID': make_terminal_ids(n, offset=n // 10)})
+
+        vec_df, vec_time = timed(update_db.upsert_legacy_dates, leg_df.copy(), cur_df, today_date)
+
+        loop_time = None
+        if n <= loop_limit:
+            loop_df, loop_time = timed(loop_upsert_legacy_dates, leg_df.copy(), cur_df, today_date)
+            assert np.array_equal(loop_df['Terminal_ID'].values, vec_df['Terminal_ID'].values)
+            assert np.array_equal(loop_df['LAST_TRANSACTION_DATE'].values, vec_df['LAST_TRANSACTION_DATE'].values)
+
+        loop_col = f'{loop_time:10.3f}' if loop_time is not None else f"{'skipped':>10}"
+        print(f'{n:>10} {vec_time:15.3f} {loop_col}')
+
+
+def run_legacy_engine(engine, current_path, legacy_path, extra_terminal_ids=None):
+    # update_legacy with the given engine against the given databases, in incremental mode
+    update_db.legacy_engine = engine
+    update_db.db_write_mode = 'incremental'
+    return update_db.update_legacy(current_path, legacy_path, extra_terminal_ids)
+
+
+def legacy_rows(path):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute('SELECT Terminal_ID, LAST_TRANSACTION_DATE FROM RCA_table ORDER BY Terminal_ID').fetchall()
+    finally:
+        conn.close()
+
+
+def bench_legacy_engines(sizes=(100_000, 1_000_000)):
+    # update_legacy in pandas against the SQL engine on the same databases: the current
+    # table overlaps 90% of the legacy one and batch mode folds in a few more terminals.
+    # The resulting legacy tables must match row for row.
+    print('update_legacy engines')
+    print(f"{'terminals':>10} {'engine':>7} {'time (s)':>9} {'peak RSS (MB)':>14}")
+    for n in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            current_path = make_rca_database(os.path.join(tmp, 'current.db'), n)
+            legacy_source = os.path.join(tmp, 'legacy_source.db')
+            with sqlite3.connect(legacy_source) as conn:
+                pd.DataFrame({'Terminal_ID': make_terminal_ids(n, offset=n // 10),
+                              'LAST_TRANSACTION_DATE': '2023-01-01'}).to_sql('RCA_table', conn, index=False)
+            conn.close()
+            extra_ids = list(make_terminal_ids(n // 100, offset=2 * n))
+            results = {}
+            for engine in ('pandas', 'sql'):
+                legacy_path = os.path.join(tmp, f'legacy_{engine}.db')
+                shutil.copy(legacy_source, legacy_path)
+                elapsed, rss = run_isolated(run_legacy_engine, engine, current_path, legacy_path, extra_ids)
+                results[engine] = legacy_rows(legacy_path)
+                print(f'{n:>10} {engine:>7} {elapsed:9.2f} {rss:14.0f}')
+            assert results['pandas'] == results['sql'], 'SQL engine does not match the pandas engine'
+            assert len(results['sql']) == n + n // 10 + n // 100
+
+
+def bench_classification(sizes=(10_000, 100_000, 1_000_000), loop_limit=10_000):
+    print('transform_file CONNECTED/STATUS classification')
+    print(f"{'terminals':>10} {'indexed (s)':>12} {'loop (s)':>10}")
+    for n in sizes:
+        reg_df, connected_df, latest_date_df = make_rca_frames(n)
+        reg_df = reg_df[['Terminal_ID', 'Merchant_Name', 'Terminal_Owner', 'LastSeenDate']]
+
+        idx_df, idx_time = timed(update_db.classify_terminals, reg_df, connected_df['Terminal_ID'], latest_date_df)
+
+        loop_time = None
+        if n <= loop_limit:
+            loop_df, loop_time = timed(loop_classify_terminals, reg_df, connected_df, latest_date_df)
+            pd.testing.assert_frame_equal(update_db.apply_rca_schema(loop_df), idx_df)
+
+        loop_col = f'{loop_time:10.3f}' if loop_time is not None else f"{'skipped':>10}"
+        print(f'{n:>10} {idx_time:12.3f} {loop_col}')
+
+
+def bench_publish(sizes=(100_000, 1_000_000)):
+    # Publish both databases to a local GitHub stand-in, then publish again unchanged
+    print('GitHub publish (local stand-in)')
+    print(f"{'terminals':>10} {'size (MB)':>10} {'first (s)':>10} {'unchanged (s)':>14} {'commits':>8}")
+    server, api_url = start_fake_github()
+    update_db.github_api_url = api_url
+    update_db.config_git.pop('BRANCH', None)
+    owner_repo = f"{update_db.config_git['USERNAME']}/{update_db.config_git['REPOSITORY']}"
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in sizes:
+            cur_path = make_rca_database(os.path.join(tmp, f'cur_{n}.db'), n)
+            leg_path = make_rca_database(os.path.join(tmp, f'leg_{n}.db'), n // 2)
+            files = [
+                (cur_path, f'bench/{n}/rca.db', f'{api_url}/repos/{owner_repo}/contents/bench/{n}/rca.db'),
+                (leg_path, f'bench/{n}/legacy.db', f'{api_url}/repos/{owner_repo}/contents/bench/{n}/legacy.db'),
+            ]
+            commits_before = len(server.state['commits'])
+            _, first_time = timed(update_db.publish_to_github, files)
+            _, second_time = timed(update_db.publish_to_github, files)
+            size_mb = (os.path.getsize(cur_path) + os.path.getsize(leg_path)) / 2**20
+            commits = len(server.state['commits']) - commits_before
+            print(f'{n:>10} {size_mb:10.1f} {first_time:10.3f} {second_time:14.3f} {commits:>8}')
+    server.shutdown()
+
+
+def bench_artifacts(n=1_000_000):
+    # Size, build time, publish time (local GitHub stand-in) and download time (local file
+    # server, decompressing on arrival) of each published form of the RCA database
+    print(f'Published artifacts ({n} terminals)')
+    server, api_url = start_fake_github()
+    update_db.github_api_url = api_url
+    update_db.config_git.pop('BRANCH', None)
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = make_rca_database(os.path.join(tmp, 'rca.db'), n)
+        artifacts = [('sqlite', db_path, 0.0)]
+        for compression, suffix in update_db.ARTIFACT_SUFFIXES.items():
+            _, elapsed = timed(update_db.compress_file, db_path, db_path + suffix, compression)
+            artifacts.append((f'sqlite {compression}', db_path + suffix, elapsed))
+        parquet_path = os.path.join(tmp, 'rca.parquet')
+        _, elapsed = timed(update_db.export_parquet, db_path, parquet_path)
+        artifacts.append(('parquet', parquet_path, elapsed))
+
+        file_server, base_url = start_file_server(tmp)
+        print(f"{'artifact':>12} {'size (MB)':>10} {'build (s)':>10} {'publish (s)':>12} {'download (s)':>13}")
+        for label, path, build_time in artifacts:
+            name = os.path.basename(path)
+            _, publish_time = timed(update_db.publish_to_github, [(path, f'bench/artifacts/{name}', None)])
+            download_time = ''
+            if not path.endswith('.parquet'):
+                dest = os.path.join(tmp, 'download.db')
+                _, elapsed = timed(update_db.download_file, f'{base_url}/{name}', dest)
+                assert update_db.file_digest(dest) == update_db.file_digest(db_path)
+                os.remove(dest)
+                os.remove(dest + '.meta.json')
+                download_time = f'{elapsed:.2f}'
+            print(f'{label:>12} {os.path.getsize(path) / 2**20:10.1f} {build_time:10.2f} {publish_time:12.2f} {download_time:>13}')
+        file_server.shutdown()
+    server.shutdown()
+
+
+def bench_rca_reader(sizes=(100_000, 500_000, XLSX_MAX_ROWS)):
+    # Larger RCA files than one xlsx sheet can hold are not possible, so the sizes
+    # stop at the sheet row limit
+    print('RCA workbook read (time / peak RSS)')
+    print(f"{'rows':>10} {'streamed (s)':>13} {'MB':>8} {'read_excel (s)':>15} {'MB':>8}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in sizes:
+            path = make_rca_workbook(os.path.join(tmp, f'rca_{n}.xlsx'), min(n, XLSX_MAX_ROWS))
+            stream_time, stream_rss = run_isolated(update_db.read_rca_workbook, path)
+            full_time, full_rss = run_isolated(read_rca_workbook_full, path)
+            print(f'{n:>10} {stream_time:13.2f} {stream_rss:8.0f} {full_time:15.2f} {full_rss:8.0f}')
+
+
+def bench_fetch(n=50_000, delay=0.5):
+    # Sequential fetches against the concurrent fetch stage, using a local file server
+    # (with a fixed latency per request) for SharePoint and both databases, and mongomock
+    print('Fetch stage (local stand-ins)')
+    with tempfile.TemporaryDirectory() as tmp:
+        make_rca_workbook(os.path.join(tmp, 'rca.xlsx'), n)
+        make_rca_database(os.path.join(tmp, 'current.db'), n)
+        make_rca_database(os.path.join(tmp, 'legacy.db'), n)
+        use_mongomock(make_journals(make_terminal_ids(n // 10), per_terminal=1))
+        server, base_url = start_file_server(tmp, delay)
+        update_db.local_db_path = os.path.join(tmp, 'local_copy.db')
+        update_db.legacy_db_path = os.path.join(tmp, 'legacy_copy.db')
+
+        def fetch_rca():
+            with urllib.request.urlopen(f'{base_url}/rca.xlsx') as response:
+                return response.read()
+
+        sources = {
+            'raw_rca': fetch_rca,
+            'latest_dates': update_db.get_recent_date,
+            'local_db': lambda: update_db.download_database(f'{base_url}/current.db'),
+            'legacy_db': lambda: update_db.download_legacy_database(f'{base_url}/legacy.db'),
+        }
+        _, sequential_time = timed(lambda: [fetch() for fetch in sources.values()])
+        # Drop the local copies so the concurrent run downloads them again
+        for path in (update_db.local_db_path, update_db.legacy_db_path):
+            os.remove(path)
+        _, concurrent_time = timed(update_db.fetch_sources, sources)
+        server.shutdown()
+    print(f"{'sequential (s)':>15} {'concurrent (s)':>15}")
+    print(f'{sequential_time:15.2f} {concurrent_time:15.2f}')
+
+
+def bench_download(size_mb=300):
+    # Throughput and peak RSS of a database download from a local HTTP server
+    print(f'Database download ({size_mb} MB, local server)')
+    print(f"{'method':>12} {'time (s)':>9} {'MB/s':>8} {'peak RSS (MB)':>14}")
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(os.path.join(tmp, 'big.db'), 'wb') as f:
+            for _ in range(size_mb):
+                f.write(os.urandom(2**20))
+        server, base_url = start_file_server(tmp)
+        url = f'{base_url}/big.db'
+        runs = [
+            ('in-memory', download_in_memory, os.path.join(tmp, 'copy_memory.db')),
+            ('streamed', update_db.download_file, os.path.join(tmp, 'copy_stream.db')),
+        ]
+        for name, func, dest in runs:
+            elapsed, rss = run_isolated(func, url, dest)
+            print(f'{name:>12} {elapsed:9.2f} {size_mb / elapsed:8.0f} {rss:14.0f}')
+        # Second streamed download hits the conditional GET
+        elapsed, _ = timed(update_db.download_file, url, runs[-1][2])
+        print(f"{'unchanged':>12} {elapsed:9.2f} {'-':>8} {'-':>14}")
+        server.shutdown()
+
+
+def bench_mongo(n=20_000, journal_terminals=3):
+    # Narrowed aggregation against the original one. VAS sees journal_terminals times more
+    # terminals than the RCA registers, which is what the $in narrowing saves. This is the
+    # DATE_CACHE off path; with the cache on, the delta aggregation is not narrowed.
+    print('VAS latest-date aggregation (BENCH_MONGO_URI or mongomock)')
+    registered = make_terminal_ids(n)
+    client = use_mongomock(make_journals(make_terminal_ids(n * journal_terminals), per_terminal=2))
+    collection = client['eftEngine']['journals_24_01_03']
+    update_db.ensure_journal_index(collection)
+
+    full_df, full_time = timed(unnarrowed_recent_date, collection)
+    narrow_df, narrow_time = timed(update_db.get_recent_date, registered)
+    expected = full_df[full_df['terminalId'].isin(registered)]
+    assert len(expected) == len(narrow_df)
+    print(f"{'registered':>10} {'narrowed (s)':>13} {'original (s)':>13}")
+    print(f'{n:>10} {narrow_time:13.2f} {full_time:13.2f}')
+
+
+def untyped_db_prep(df):
+    # The original connect_and_update_database() preparation, kept here as the baseline
+    df = df.astype(str)
+    df['LAST_TRANSACTION_DATE'] = df['LAST_TRANSACTION_DATE'].apply(lambda x: x if pd.to_datetime(x, errors='coerce') is not pd.NaT else 'Not available')
+    df['LAST_TRANSACTION_DATE'] = pd.to_datetime(df['LAST_TRANSACTION_DATE'], errors='coerce')
+    df['LAST_TRANSACTION_DATE'] = df['LAST_TRANSACTION_DATE'].dt.date
+    return df
+
+
+def bench_schema(n=1_000_000):
+    # Memory footprint of the classified RCA frame and the time to prepare it for
+    # SQLite, as Python objects against the typed schema
+    print(f'RCA frame schema ({n} terminals)')
+    reg_df, connected_df, latest_date_df = make_rca_frames(n)
+    reg_df = reg_df[['Terminal_ID', 'Merchant_Name', 'Terminal_Owner', 'LastSeenDate']]
+    typed_df, typed_classify = timed(update_db.classify_terminals, reg_df, connected_df['Terminal_ID'], latest_date_df)
+    untyped_df = typed_df.astype(object)
+    untyped_df['LAST_TRANSACTION_DATE'] = typed_df['LAST_TRANSACTION_DATE']
+
+    _, untyped_prep = timed(untyped_db_prep, untyped_df)
+    _, typed_prep = timed(update_db.prepare_rca_for_db, typed_df)
+    untyped_mb = untyped_df.memory_usage(deep=True).sum() / 2**20
+    typed_mb = typed_df.memory_usage(deep=True).sum() / 2**20
+    print(f"{'schema':>8} {'memory (MB)':>12} {'db prep (s)':>12}")
+    print(f"{'objects':>8} {untyped_mb:12.1f} {untyped_prep:12.2f}")
+    print(f"{'typed':>8} {typed_mb:12.1f} {typed_prep:12.2f}")
+    print(f'typed classification took {typed_classify:.2f}s')
+
+
+def evolve_rca(df, rng, status_churn, date_share, day):
+    # Next day's RCA table: a share of terminals flips status, and a share of the active
+    # terminals transacts on the day
+    df = df.copy()
+    flip = rng.random(len(df)) < status_churn
+    df.loc[flip, 'STATUS'] = np.where(df.loc[flip, 'STATUS'] == 'ACTIVE', 'INACTIVE', 'ACTIVE')
+    transacted = (df['STATUS'] == 'ACTIVE').to_numpy() & (rng.random(len(df)) < date_share)
+    df.loc[transacted, 'LAST_TRANSACTION_DATE'] = day.strftime('%Y-%m-%d')
+    return df
+
+
+def bench_history(n=100_000, days=30, status_churn=0.02, date_share=0.3):
+    # Size of the RCA_history change log after a month of daily runs, against keeping a
+    # full copy of RCA_table per run, and the time of a state-as-of query
+    print(f'RCA history ({n} terminals, {days} daily runs)')
+    rng = np.random.default_rng(0)
+    reg_df, connected_df, latest_date_df = make_rca_frames(n)
+    reg_df = reg_df[['Terminal_ID', 'Merchant_Name', 'Terminal_Owner', 'LastSeenDate']]
+    first = update_db.prepare_rca_for_db(
+        update_db.classify_terminals(reg_df, connected_df['Terminal_ID'], latest_date_df)).astype(object)
+    start = datetime(2024, 2, 1, 6)
+    runs = [first]
+    for day in range(1, days):
+        runs.append(evolve_rca(runs[-1], rng, status_churn, date_share, start + timedelta(days=day)))
+
+    print(f"{'store':>26} {'size (MB)':>10} {'record (s/run)':>15} {'as-of (s)':>10}")
+    with tempfile.TemporaryDirectory() as tmp:
+        snapshot_path = os.path.join(tmp, 'snapshots.db')
+        with sqlite3.connect(snapshot_path) as conn:
+            for day, df in enumerate(runs):
+                df.assign(SNAPSHOT=(start + timedelta(days=day)).strftime('%Y-%m-%d')).to_sql(
+                    'RCA_snapshots', conn, if_exists='append', index=False)
+        conn.close()
+        print(f"{'snapshot per run':>26} {os.path.getsize(snapshot_path) / 2**20:10.1f} {'':>15} {'':>10}")
+
+        # A retention window shorter than the simulated month, queried inside the window
+        for label, columns, retention, as_of_day in [
+                ('history, all columns', update_db.RCA_CHANGE_COLUMNS, 0, days // 2),
+                ('history, status only', ['STATUS', 'CONNECTED'], 0, days // 2),
+                ('status only, 7 day window', ['STATUS', 'CONNECTED'], 7, days - 1)]:
+            path = os.path.join(tmp, 'history.db')
+            if os.path.exists(path):
+                os.remove(path)
+            conn = sqlite3.connect(path)
+            record_total = 0.0
+            for day, df in enumerate(runs):
+                ts = int((start + timedelta(days=day)).timestamp())
+                _, elapsed = timed(update_db.record_history, conn, df, ts, columns, retention)
+                record_total += elapsed
+            conn.execute('VACUUM')
+            conn.close()
+            state, as_of = timed(update_db.state_as_of, (start + timedelta(days=as_of_day)).date(), path, columns)
+            assert len(state) == n
+            print(f'{label:>26} {os.path.getsize(path) / 2**20:10.1f} {record_total / days:15.2f} {as_of:10.2f}')
+
+
+# Typical reads of the dashboard: terminal lookups, status filters and the counts by
+# owner/status/connected, which the finalized database serves from RCA_summary
+DASHBOARD_QUERIES = [
+    ('lookup terminal', 'SELECT * FROM RCA_table WHERE Terminal_ID = ?', 'terminal'),
+    ('count by status', 'SELECT STATUS, COUNT(*) FROM RCA_table GROUP BY STATUS', None),
+    ('inactive connected', "SELECT COUNT(*) FROM RCA_table WHERE STATUS = 'INACTIVE' AND CONNECTED = 'YES'", None),
+    ('active since date', "SELECT Terminal_ID FROM RCA_table WHERE LAST_TRANSACTION_DATE >= '2024-01-28'", None),
+    ('owner breakdown', 'SELECT Terminal_Owner, STATUS, CONNECTED, COUNT(*) FROM RCA_table '
+                        'GROUP BY Terminal_Owner, STATUS, CONNECTED', 'summary'),
+]
+
+
+def time_dashboard_queries(path, terminal_ids, lookups=1000):
+    # Seconds per query; lookups are averaged over random terminals
+    conn = sqlite3.connect(path)
+    has_summary = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'RCA_summary'").fetchone()
+    times = []
+    for _, query, kind in DASHBOARD_QUERIES:
+        if kind == 'summary' and has_summary:
+            query = 'SELECT Terminal_Owner, STATUS, CONNECTED, TERMINALS FROM RCA_summary'
+        if kind == 'terminal':
+            start = time.perf_counter()
+            for tid in terminal_ids[:lookups]:
+                conn.execute(query, (tid,)).fetchall()
+            times.append((time.perf_counter() - start) / lookups)
+        else:
+            _, elapsed = timed(lambda: conn.execute(query).fetchall())
+            times.append(elapsed)
+    conn.close()
+    return times
+
+
+def bench_finalize(n=1_000_000):
+    # Dashboard queries against the plain to_sql output and the finalized database
+    print(f'Published database queries ({n} terminals)')
+    reg_df, connected_df, latest_date_df = make_rca_frames(n)
+    reg_df = reg_df[['Terminal_ID', 'Merchant_Name', 'Terminal_Owner', 'LastSeenDate']]
+    df = update_db.prepare_rca_for_db(
+        update_db.classify_terminals(reg_df, connected_df['Terminal_ID'], latest_date_df))
+    terminal_ids = list(np.random.default_rng(0).permutation(df['Terminal_ID'].to_numpy()))
+    with tempfile.TemporaryDirectory() as tmp:
+        plain_path = os.path.join(tmp, 'plain.db')
+        with sqlite3.connect(plain_path) as conn:
+            df.drop(columns=['terminalId']).to_sql('RCA_table', conn, index=False)
+        conn.close()
+        results = {'to_sql': (os.path.getsize(plain_path), 0.0, time_dashboard_queries(plain_path, terminal_ids))}
+        for page_size in (4096, 16384, 65536):
+            path = os.path.join(tmp, f'finalized_{page_size}.db')
+            shutil.copy(plain_path, path)
+            update_db.db_page_size = page_size
+            _, elapsed = timed(update_db.finalize_database, path)
+            results[f'finalized {page_size // 1024}K'] = (os.path.getsize(path), elapsed, time_dashboard_queries(path, terminal_ids))
+        update_db.db_page_size = BENCH_CONFIG['directories'].get('DB_PAGE_SIZE', 16384)
+
+    labels = list(results)
+    print(f"{'query (ms)':>20} " + ' '.join(f'{label:>15}' for label in labels))
+    for i, (name, _, _) in enumerate(DASHBOARD_QUERIES):
+        print(f'{name:>20} ' + ' '.join(f'{results[label][2][i] * 1000:15.3f}' for label in labels))
+    print(f"{'size (MB)':>20} " + ' '.join(f'{results[label][0] / 2**20:15.1f}' for label in labels))
+    print(f"{'finalize (s)':>20} " + ' '.join(f'{results[label][1]:15.2f}' for label in labels))
+
+
+def bench_batch(files=8, n=100_000):
+    # Parse step of batch mode: a backlog of raw RCA files read by a process pool
+    print(f'Batch RCA parse ({files} files of {n} rows)')
+    print(f"{'workers':>8} {'time (s)':>9} {'files/s':>8}")
+    with tempfile.TemporaryDirectory() as tmp:
+        source = make_rca_workbook(os.path.join(tmp, 'source.xlsx'), n)
+        paths = []
+        for i in range(files):
+            path = os.path.join(tmp, f'RCA_2024-01-{i + 1:02d}.xlsx')
+            os.link(source, path)
+            paths.append(path)
+        workers = 1
+        while True:
+            _, elapsed = timed(update_db.parse_rca_batch, paths, workers)
+            print(f'{workers:>8} {elapsed:9.2f} {files / elapsed:8.2f}')
+            if workers >= min(files, os.cpu_count()):
+                break
+            workers = min(workers * 2, files, os.cpu_count())
+
+
+def sequential_retrieve(ctx, folder_url, dest_dir):
+    # The original retrieve_rca_from_sharepoint(): one execute_query per file download
+    folder = ctx.web.get_folder_by_server_relative_url(folder_url)
+    ctx.load(folder)
+    ctx.execute_query()
+    files = folder.files
+    ctx.load(files)
+    ctx.execute_query()
+    for file in files:
+        with open(os.path.join(dest_dir, file.properties['Name']), 'wb') as local_file:
+            file.download(local_file)
+            ctx.execute_query()
+
+
+def upload_then_delete(ctx, local_dir, input_url, archive_url):
+    # The original move_raw_rca_to_archive(): upload every local copy, then delete the inputs
+    for name in os.listdir(local_dir):
+        target_folder = ctx.web.get_folder_by_server_relative_url(archive_url)
+        with open(os.path.join(local_dir, name), 'rb') as f:
+            target_folder.upload_file(name, f.read())
+            ctx.execute_query()
+    files = ctx.web.get_folder_by_server_relative_url(input_url).files
+    ctx.load(files)
+    ctx.execute_query()
+    for file in files:
+        file.delete_object()
+    ctx.execute_query()
+
+
+def bench_sharepoint(files=8, size_mb=20, delay=0.05):
+    # Retrieve, archive and upload against the fake SharePoint server with a fixed
+    # per-request latency
+    print(f'SharePoint retrieve, archive and upload ({files} files of {size_mb} MB, {delay * 1000:.0f} ms latency)')
+    print(f"{'method':>20} {'time (s)':>9} {'requests':>9}")
+    input_url = update_db.sharepoint_input_folder
+    archive_url = update_db.sharepoint_archive_folder
+    contents = {f'{input_url}/RCA_2024-01-{i + 1:02d}.xlsx': os.urandom(size_mb * 2**20) for i in range(files)}
+
+    def run(name, func, *args):
+        server.requests = 0
+        _, elapsed = timed(func, *args)
+        print(f'{name:>20} {elapsed:9.2f} {server.requests:>9}')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        server, ctx = start_fake_sharepoint(contents, delay)
+        update_db._sharepoint_context = ctx
+        update_db.inputrca_loc = os.path.join(tmp, 'input') + os.sep
+        run('sequential download', sequential_retrieve, ctx, input_url, tmp)
+        run('concurrent download', update_db.retrieve_rca_from_sharepoint)
+        run('upload then delete', upload_then_delete, ctx, update_db.inputrca_loc, input_url, archive_url)
+        server.files.update(contents)
+        run('server-side move', update_db.move_raw_rca_to_archive)
+
+        # Chunked upload of a processed file, with the first chunks failing: each failed
+        # chunk is resent from the acknowledged offset and the file arrives whole
+        upload_path = os.path.join(tmp, 'processed_rca.xlsx')
+        with open(upload_path, 'wb') as f:
+            f.write(contents[f'{input_url}/RCA_2024-01-01.xlsx'])
+        processed_url = update_db.sharepoint_processed_folder or archive_url
+        server.fail_chunks = update_db.sharepoint_upload_retries - 1
+        run('chunked upload', update_db.upload_to_sharepoint, upload_path, processed_url, size_mb * 2**20 // 4)
+        assert server.fail_chunks == 0
+        assert server.files[f'{processed_url}/processed_rca.xlsx'] == contents[f'{input_url}/RCA_2024-01-01.xlsx']
+        server.shutdown()
+
+
+def import_times(statement):
+    # Cumulative import time in microseconds of every module statement imports, from
+    # python -X importtime in a fresh interpreter
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement],
+                            capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    times = {}
+    for line in result.stderr.splitlines():
+        match = re.match(r'import time:\s+\d+ \|\s+(\d+) \|\s+(\S+)$', line)
+        if match:
+            times[match.group(2)] = int(match.group(1))
+    return times
+
+
+def bench_import():
+    # Regression check for the startup cost: importing update_db must not load any heavy
+    # dependency, which the stages import when they first need them
+    print('Import time (python -X importtime)')
+    times = import_times('import update_db')
+    loaded = [name for name in times if name.split('.')[0] in HEAVY_MODULES]
+    assert not loaded, f'importing update_db loads {sorted(set(n.split(".")[0] for n in loaded))}'
+    eager = import_times('import ' + ', '.join(HEAVY_MODULES[:-1] + ['office365.sharepoint.client_context']))
+    print(f"{'update_db (ms)':>15} {'dependencies (ms)':>18}")
+    print(f"{times['update_db'] / 1000:15.1f} {sum(eager[name] for name in eager if '.' not in name) / 1000:18.1f}")
+
+
+# End-to-end run of update_db.main() against local stand-ins: a file server for the
+# database URLs, the GitHub and SharePoint stand-ins, and mongomock (or a local mongod
+# through BENCH_MONGO_URI). The stage metrics of the run report are kept in a results
+# file that later runs are compared against.
+REGRESSION_THRESHOLD = 0.2
+# Stages shorter than this are not flagged, their timings are mostly noise
+REGRESSION_MIN_SECONDS = 0.05
+
+
+def git_commit():
+    result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    return result.stdout.strip() or None
+
+
+def stage_results(report):
+    # Metrics per stage name, summed over the calls of the stage, peak RSS as the maximum
+    stages = {}
+    for metrics in report['stages']:
+        entry = stages.setdefault(metrics['stage'], {
+            'calls': 0, 'wall_seconds': 0.0, 'thread_cpu_seconds': 0.0, 'peak_rss_mb': 0.0,
+            'bytes_read': 0, 'bytes_written': 0, 'rows': None,
+        })
+        entry['calls'] += 1
+        entry['wall_seconds'] = round(entry['wall_seconds'] + metrics['wall_seconds'], 4)
+        entry['thread_cpu_seconds'] = round(entry['thread_cpu_seconds'] + metrics['thread_cpu_seconds'], 4)
+        entry['peak_rss_mb'] = max(entry['peak_rss_mb'], round(metrics['peak_rss_bytes'] / 2**20, 1))
+        entry['bytes_read'] += metrics['bytes_read'] or 0
+        entry['bytes_written'] += metrics['bytes_written'] or 0
+        if metrics['rows'] is not None:
+            entry['rows'] = (entry['rows'] or 0) + metrics['rows']
+    return stages
+
+
+def bench_pipeline(n=20_000, active_share=0.5, latency=0.0, results_path=None):
+    # Generate an RCA workbook, journals and current/legacy databases for n terminals,
+    # run the whole pipeline against the stand-ins and return its results
+    print(f'End-to-end pipeline ({n} terminals, {latency * 1000:.0f} ms latency)')
+    tmp = tempfile.mkdtemp(prefix='rca_pipeline_bench_')
+    try:
+        served = os.path.join(tmp, 'served')
+        os.makedirs(served)
+        make_rca_database(os.path.join(served, 'rca.db'), n)
+        # The legacy table holds 90% of the fleet plus terminals that left it
+        make_legacy_database(os.path.join(served, 'legacy.db'), n, offset=n // 10)
+        workbook_path = make_rca_workbook(os.path.join(tmp, 'rca.xlsx'), n)
+        terminal_ids = make_terminal_ids(n)
+        journals = make_journals(terminal_ids[np.random.default_rng(0).random(n) < active_share])
+
+        file_server, files_url = start_file_server(served, latency)
+        github, github_url = start_fake_github()
+        input_folder = '/sites/NIBSS-ITEXrepo/Shared Documents/RCA_input'
+        with open(workbook_path, 'rb') as workbook:
+            rca_file = {f'{input_folder}/RCA_{date.today().isoformat()}.xlsx': workbook.read()}
+        sharepoint, ctx = start_fake_sharepoint(rca_file, latency)
+        use_mongomock(journals)
+
+        contents_url = f'{github_url}/repos/bench/rca/contents'
+        config = json.loads(json.dumps(BENCH_CONFIG))
+        config['directories'].update({
+            'RAW_DB': f'{files_url}/rca.db', 'LEG_DB': f'{files_url}/legacy.db',
+            'SHA_DB': f'{contents_url}/rca.db', 'LEG_SHA': f'{contents_url}/legacy.db',
+            'WORKSPACE_DIR': os.path.join(tmp, 'workspace'),
+            'DATE_CACHE_DB': os.path.join(tmp, 'latest_dates.db'),
+            'RUN_REPORT': os.path.join(tmp, 'run_report.json'),
+            'RUN_STATE': os.path.join(tmp, 'run_state.json'),
+        })
+        config['github'].update({'API_URL': github_url, 'PATH': 'rca.db', 'LEG_PATH': 'legacy.db'})
+        config['sharepoint'].update({'SITE': ctx.base_url, 'INPUT_FOLDER': input_folder})
+        update_db.apply_config(config)
+        update_db._sharepoint_context = ctx
+
+        _, elapsed = timed(update_db.main)
+        with open(update_db.run_report_path) as report_file:
+            report = json.load(report_file)
+        assert not sharepoint.files.get(next(iter(rca_file))), 'raw RCA file was not archived'
+        assert github.state['ref'] != 'c0', 'nothing was published'
+
+        for server in (file_server, github, sharepoint):
+            server.shutdown()
+    finally:
+        update_db.apply_config(BENCH_CONFIG)
+        update_db._sharepoint_context = None
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    results = {
+        'benchmark': 'pipeline',
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'scale': {'terminals': n, 'journals': len(journals), 'latency_seconds': latency},
+        'total_seconds': round(elapsed, 4),
+        'stages': stage_results(report),
+    }
+    if results_path:
+        with open(results_path, 'w') as results_file:
+            json.dump(results, results_file, indent=2)
+        print(f'Results written to {results_path}')
+    return results
+
+
+def compare_results(baseline, results, threshold=REGRESSION_THRESHOLD):
+    # Print the stage timings next to a baseline results file and return the stages whose
+    # wall time grew by more than threshold
+    if baseline.get('scale') != results.get('scale'):
+        print(f"Baseline scale {baseline.get('scale')} differs from {results.get('scale')}")
+    print(f"{'stage':>28} {'baseline (s)':>13} {'current (s)':>12} {'change':>8} {'peak RSS (MB)':>14}")
+    regressions = []
+    rows = [(name, stage.get('wall_seconds'), stage) for name, stage in results['stages'].items()]
+    rows.append(('total', results['total_seconds'], {}))
+    for name, wall, stage in rows:
+        before = baseline['total_seconds'] if name == 'total' else baseline['stages'].get(name, {}).get('wall_seconds')
+        change, flag = '', ''
+        if before:
+            change = f'{(wall - before) / before:+.0%}'
+            if wall > before * (1 + threshold) and wall - before > REGRESSION_MIN_SECONDS:
+                flag = ' REGRESSION'
+                regressions.append(name)
+        before_col = f'{before:13.2f}' if before is not None else f"{'-':>13}"
+        rss = f"{stage['peak_rss_mb']:14.0f}" if stage else f"{'':>14}"
+        print(f'{name:>28} {before_col} {wall:12.2f} {change:>8} {rss}{flag}')
+    return regressions
+
+
+def print_pipeline_results(results):
+    print(f"{'stage':>28} {'calls':>6} {'wall (s)':>9} {'thread cpu (s)':>15} {'peak RSS (MB)':>14} {'rows':>9}")
+    for name, stage in results['stages'].items():
+        rows = stage['rows'] if stage['rows'] is not None else '-'
+        print(f"{name:>28} {stage['calls']:>6} {stage['wall_seconds']:9.2f} {stage['thread_cpu_seconds']:15.2f} "
+              f"{stage['peak_rss_mb']:14.0f} {rows:>9}")
+    print(f"{'total':>28} {'':>6} {results['total_seconds']:9.2f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks of the RCA pipeline on synthetic data.')
+    parser.add_argument('--full', action='store_true',
+                        help='also time the original per-terminal loops at the largest sizes')
+    parser.add_argument('--pipeline', action='store_true', help='run only the end-to-end pipeline benchmark')
+    parser.add_argument('--terminals', type=int, default=20_000, help='terminals of the end-to-end run')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='per-request latency of the stand-in servers in seconds')
+    parser.add_argument('--results', default='benchmark_results.json', help='results file of the end-to-end run')
+    parser.add_argument('--baseline', help='earlier results file to compare the end-to-end run against')
+    args = parser.parse_args(argv)
+
+    if not args.pipeline:
+        loop_limit = 1_000_000 if args.full else 10_000
+        bench_import()
+        bench_update_legacy(loop_limit=loop_limit)
+        bench_legacy_engines()
+        bench_classification(loop_limit=loop_limit)
+        bench_publish()
+        bench_artifacts()
+        bench_rca_reader()
+        bench_fetch()
+        bench_download()
+        bench_mongo()
+        bench_schema()
+        bench_history()
+        bench_finalize()
+        bench_batch()
+        bench_sharepoint()
+
+    results = bench_pipeline(args.terminals, latency=args.latency, results_path=args.results)
+    print_pipeline_results(results)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare_results(json.load(baseline_file), results)
+        if regressions:
+            print(f"Regressions: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,66 +1,451 @@
-import pandas as pd
+import argparse
 import sqlite3
-import requests
 import base64
+import contextlib
+import cProfile
+import difflib
+import functools
+import gzip
+import hashlib
+import importlib.util
 import os
-import psutil
+import re
+import shutil
+import signal
+import sys
+import tempfile
+import threading
 import time
-from pymongo import MongoClient
 import urllib.parse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import json
 from datetime import datetime, timedelta, date
-from office365.sharepoint.client_context import ClientContext
-from office365.sharepoint.files.file import File
-from office365.runtime.auth.user_credential import UserCredential
+import uuid
+
+
+def lazy_import(name):
+    # Module that is only loaded on first attribute access, so importing update_db (to run
+    # a single stage, or from a test) does not pay for pandas up front
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+pd = lazy_import('pandas')
 
 
 # Adding the configuration file to boost credential security
 ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
 config_path = '\\'.join([ROOT_DIR, 'credentials.json'])
-
-# read json file
-with open(config_path) as config_file:
-    config = json.load(config_file)
+config = None
+
+
+def load_config(path=None):
+    # Read credentials.json once and apply it; later calls return the loaded config.
+    # Nothing is read at import time, so the module imports without credentials.
+    if config is None:
+        with open(path or config_path) as config_file:
+            apply_config(json.load(config_file))
+    return config
+
+
+def apply_config(new_config):
+    # Set the module settings from a config dict shaped like credentials.json
+    global config, config_dir, config_sp, config_ftp, config_git, config_mongo
+    global raw_url, leg_url, sha_url, leg_sha, rca_loc, inputrca_loc, local_db_path, legacy_db_path
+    global workspace_root, stale_workspace_hours, db_write_mode, legacy_engine, history_enabled, history_columns, history_retention_days, finalize_db, db_page_size
+    global download_timeout, artifact_compression, compression_level, publish_raw, publish_parquet, download_retries, download_backoff
+    global github_api_url, sharepoint_site_url, sharepoint_username, sharepoint_password
+    global sharepoint_input_folder, sharepoint_archive_folder, sharepoint_processed_folder
+    global sharepoint_download_workers, sharepoint_upload_chunk_size, sharepoint_upload_retries
+    global run_report_path, prometheus_textfile, profile_stages, profile_dir, profiler_name
+    global mongo_collection, mongo_collection_pattern, mongo_lookback_days, mongo_in_batch, mongo_cursor_batch
+    global date_cache_enabled, date_cache_path, watermark_overlap
+    global checkpoint_processed_rca, export_processed_xlsx, batch_workers, run_state_path
+    global conflict_report_path, max_conflict_share, max_row_drop, max_row_growth
+    global service_poll_interval, service_max_backoff
+
+    config = new_config
     config_dir = config['directories']
     config_sp = config['sharepoint']
-    config_ftp = config['ftp']
+    config_ftp = config.get('ftp', {})
     config_git = config['github']
     config_mongo = config['mongodb']
 
-# Defining file paths for downloads
-raw_url = config_dir['RAW_DB']
-leg_url = config_dir['LEG_DB']
-sha_url = config_dir['SHA_DB']
-leg_sha = config_dir['LEG_SHA']
-rca_loc = config_dir['PROCESSED_RCA_LOC']
-inputrca_loc = config_dir['RAW_RCA_LOC']
-# SharePoint Details
-sharepoint_site_url = config_sp['SITE']
-sharepoint_username = config_sp['USERNAME']
-sharepoint_password = config_sp['PASSWORD']
+    # Defining file paths for downloads
+    raw_url = config_dir['RAW_DB']
+    leg_url = config_dir['LEG_DB']
+    sha_url = config_dir['SHA_DB']
+    leg_sha = config_dir['LEG_SHA']
+    rca_loc = config_dir['PROCESSED_RCA_LOC']
+    inputrca_loc = config_dir['RAW_RCA_LOC']
+    local_db_path = config_dir['LOCAL_DB']
+    legacy_db_path = config_dir['LEGACY_DB']
+    # Parent of the per-run workspaces that hold every downloaded and processed file of a run
+    workspace_root = config_dir.get('WORKSPACE_DIR', os.path.join(tempfile.gettempdir(), 'rca_pipeline'))
+    # Age after which a workspace without a live owner process on this host is abandoned
+    stale_workspace_hours = config_dir.get('STALE_WORKSPACE_HOURS', 24)
+    # 'incremental' upserts changed rows only, 'replace' rewrites the whole table
+    db_write_mode = config_dir.get('DB_WRITE_MODE', 'incremental')
+    # 'pandas' reconciles the legacy dates in dataframes, 'sql' inside SQLite
+    legacy_engine = config_dir.get('LEGACY_ENGINE', 'pandas')
+    # Append-only change log of RCA_table, the columns whose changes it records, and the
+    # days of history it keeps when compaction is wanted (None keeps all of it)
+    history_enabled = config_dir.get('RCA_HISTORY', True)
+    history_columns = config_dir.get('HISTORY_COLUMNS', ['STATUS', 'CONNECTED'])
+    history_retention_days = config_dir.get('HISTORY_RETENTION_DAYS')
+    # Index, summarize, ANALYZE and VACUUM the databases before they are published
+    finalize_db = config_dir.get('FINALIZE_DB', True)
+    db_page_size = config_dir.get('DB_PAGE_SIZE', 16384)
+    # Download tuning
+    download_timeout = config_dir.get('DOWNLOAD_TIMEOUT', 60)
+    download_retries = config_dir.get('DOWNLOAD_RETRIES', 3)
+    download_backoff = config_dir.get('DOWNLOAD_BACKOFF', 2)
+    # GitHub API root, overridable to point at a stand-in server
+    github_api_url = config_git.get('API_URL', 'https://api.github.com')
+    # Published artifacts: a gzip or zstd copy of each database, a Parquet export of
+    # RCA_table, and whether the uncompressed database is still published
+    artifact_compression = config_git.get('COMPRESSION')
+    compression_level = config_git.get('COMPRESSION_LEVEL')
+    publish_parquet = config_git.get('PARQUET', False)
+    publish_raw = config_git.get('PUBLISH_RAW', True)
+    # SharePoint Details
+    sharepoint_site_url = config_sp['SITE']
+    sharepoint_username = config_sp['USERNAME']
+    sharepoint_password = config_sp['PASSWORD']
+    sharepoint_input_folder = config_sp.get('INPUT_FOLDER', '/sites/NIBSS-ITEXrepo/Shared Documents/RCA_input')
+    sharepoint_archive_folder = config_sp.get('ARCHIVE_FOLDER', '/sites/NIBSS-ITEXrepo/Shared Documents/RCA_archives')
+    sharepoint_processed_folder = config_sp.get('PROCESSED_FOLDER')
+    sharepoint_download_workers = config_sp.get('DOWNLOAD_WORKERS', 4)
+    sharepoint_upload_chunk_size = config_sp.get('UPLOAD_CHUNK_SIZE', 10 * 1024 * 1024)
+    sharepoint_upload_retries = config_sp.get('UPLOAD_RETRIES', 3)
+    # Run report and profiling
+    run_report_path = config_dir.get('RUN_REPORT', os.path.join(ROOT_DIR, 'run_report.json'))
+    prometheus_textfile = config_dir.get('PROMETHEUS_TEXTFILE')
+    profile_stages = config_dir.get('PROFILE_STAGES', [])
+    profile_dir = config_dir.get('PROFILE_DIR', os.path.join(ROOT_DIR, 'profiles'))
+    profiler_name = config_dir.get('PROFILER', 'cprofile')
+
+    # VAS journal settings. COLLECTION_PATTERN (a strftime pattern such as 'journals_%y_%m_%d')
+    # enables rotating collections named by their start date; otherwise COLLECTION is used.
+    mongo_collection = config_mongo.get('COLLECTION', 'journals_24_01_03')
+    mongo_collection_pattern = config_mongo.get('COLLECTION_PATTERN')
+    mongo_lookback_days = config_mongo.get('LOOKBACK_DAYS', 30)
+    mongo_in_batch = config_mongo.get('IN_BATCH_SIZE', 10000)
+    mongo_cursor_batch = config_mongo.get('CURSOR_BATCH_SIZE', 10000)
+    # Local sidecar cache of the latest date per terminal and the updatedAt watermark
+    date_cache_enabled = config_mongo.get('DATE_CACHE', True)
+    date_cache_path = config_dir.get('DATE_CACHE_DB', os.path.join(ROOT_DIR, 'latest_dates.db'))
+    watermark_overlap = timedelta(minutes=config_mongo.get('WATERMARK_OVERLAP_MINUTES', 60))
+
+    # Optional outputs of transform_file: a Parquet checkpoint to inspect or restart from,
+    # and the processed xlsx export, written on a background thread
+    checkpoint_processed_rca = config_dir.get('CHECKPOINT_PROCESSED_RCA', False)
+    export_processed_xlsx = config_dir.get('EXPORT_PROCESSED_XLSX', False)
+    # Up-front checks of the raw RCA: the share of terminals allowed to be listed twice with
+    # different details, and the largest drop or growth of the terminal count against the
+    # published RCA_table (None disables a check)
+    conflict_report_path = config_dir.get('CONFLICT_REPORT', os.path.join(ROOT_DIR, 'terminal_conflicts.csv'))
+    max_conflict_share = config_dir.get('MAX_CONFLICT_SHARE', 0.01)
+    max_row_drop = config_dir.get('MAX_ROW_DROP', 0.1)
+    max_row_growth = config_dir.get('MAX_ROW_GROWTH', 0.5)
+    # Processes parsing a backlog of raw RCA files
+    batch_workers = config_dir.get('BATCH_WORKERS') or os.cpu_count()
+    # Checkpoints of the stage runner, used to resume a failed run and skip unchanged stages
+    run_state_path = config_dir.get('RUN_STATE', os.path.join(ROOT_DIR, 'run_state.json'))
+    # Service mode: poll interval and the longest retry delay, in seconds
+    service_poll_interval = config_dir.get('SERVICE_POLL_INTERVAL', 300)
+    service_max_backoff = config_dir.get('SERVICE_MAX_BACKOFF', 3600)
+
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Metrics of every stage run in this process, in the order they finished
+run_metrics = []
+_metrics_lock = threading.Lock()
+
+
+def io_bytes():
+    # Bytes read and written by this process so far, sockets included where the
+    # platform reports them
+    import psutil
+    try:
+        counters = psutil.Process().io_counters()
+    except (AttributeError, psutil.Error):
+        return 0, 0
+    return (getattr(counters, 'read_chars', counters.read_bytes),
+            getattr(counters, 'write_chars', counters.write_bytes))
+
+
+def stage_rows(result):
+    # Row count of a stage result: the length of a dataframe, or the total of upsert counts.
+    # The type is matched by name: pd is a lazy module, so touching pd.DataFrame here
+    # would load pandas after every stage.
+    if type(result).__name__ == 'DataFrame':
+        return len(result)
+    if isinstance(result, dict) and 'inserted' in result:
+        return sum(result[key] for key in ('inserted', 'updated', 'unchanged', 'deleted'))
+    return None
+
+
+# Held while a stage is being profiled. Stages call other stages, and fetch stages run on
+# pool threads, but only one profiler can be active at a time: a second cProfile raises on
+# Python 3.12+ and silently stops the first one before that. A stage that starts while
+# another is profiled runs unprofiled, and shows up inside the outer profile instead.
+_profile_lock = threading.Lock()
+
+
+def profile_call(name, func, *args, **kwargs):
+    # Run func under the configured profiler and write its output to profile_dir
+    if not _profile_lock.acquire(blocking=False):
+        return func(*args, **kwargs)
+    try:
+        os.makedirs(profile_dir, exist_ok=True)
+        if profiler_name == 'pyinstrument':
+            from pyinstrument import Profiler
+            profiler = Profiler()
+            profiler.start()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profiler.stop()
+                with open(os.path.join(profile_dir, f'{name}.html'), 'w') as f:
+                    f.write(profiler.output_html())
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(func, *args, **kwargs)
+        finally:
+            profiler.dump_stats(os.path.join(profile_dir, f'{name}.prof'))
+    finally:
+        _profile_lock.release()
+
+
+def stage(func):
+    # Record wall time, CPU time of the calling thread, peak RSS, bytes read/written and
+    # row count of each call, and profile it when its name is listed in PROFILE_STAGES.
+    # RSS and IO are process wide, so stages running concurrently share them. The CPU time
+    # leaves out work the stage hands to thread or process pools, so it is reported as
+    # thread_cpu_seconds.
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        import psutil
+        process = psutil.Process()
+        peak_rss = [process.memory_info().rss]
+        done = threading.Event()
+
+        def sample_rss():
+            while not done.wait(0.05):
+                peak_rss[0] = max(peak_rss[0], process.memory_info().rss)
+
+        sampler = threading.Thread(target=sample_rss, daemon=True)
+        sampler.start()
+        read_start, write_start = io_bytes()
+        started_at = datetime.now()
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        status = 'ok'
+        result = None
+        try:
+            if name in profile_stages or 'all' in profile_stages:
+                result = profile_call(name, func, *args, **kwargs)
+            else:
+                result = func(*args, **kwargs)
+            return result
+        except Exception:
+            status = 'error'
+            raise
+        finally:
+            thread_cpu_time = time.thread_time() - cpu_start
+            wall_time = time.perf_counter() - wall_start
+            done.set()
+            sampler.join()
+            read_end, write_end = io_bytes()
+            metrics = {
+                'stage': name,
+                'status': status,
+                'started_at': started_at.isoformat(timespec='seconds'),
+                'wall_seconds': round(wall_time, 4),
+                'thread_cpu_seconds': round(thread_cpu_time, 4),
+                'peak_rss_bytes': max(peak_rss[0], process.memory_info().rss),
+                'bytes_read': read_end - read_start,
+                'bytes_written': write_end - write_start,
+                'rows': stage_rows(result),
+            }
+            with _metrics_lock:
+                run_metrics.append(metrics)
+            print(f"Stage {name} took {wall_time:.2f}s (thread cpu {thread_cpu_time:.2f}s)")
+
+    return wrapper
 
 
-def retrieve_rca_from_sharepoint():
+def write_run_report(started_at):
+    # JSON report of every stage of the run, plus a Prometheus textfile when configured
+    report = {
+        'started_at': started_at.isoformat(timespec='seconds'),
+        'finished_at': datetime.now().isoformat(timespec='seconds'),
+        'stages': run_metrics,
+    }
+    try:
+        with open(run_report_path, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Run report written to {run_report_path}')
+    except Exception as e:
+        print(f'An error occurred writing the run report: {e}')
+
+    if not prometheus_textfile:
+        return
+    metric_fields = [
+        ('wall_seconds', 'rca_stage_wall_seconds', 'Wall clock time of the stage'),
+        ('thread_cpu_seconds', 'rca_stage_thread_cpu_seconds',
+         'CPU time of the thread running the stage, without its thread or process pools'),
+        ('peak_rss_bytes', 'rca_stage_peak_rss_bytes', 'Peak resident memory of the process during the stage'),
+        ('bytes_read', 'rca_stage_bytes_read', 'Bytes read by the process during the stage'),
+        ('bytes_written', 'rca_stage_bytes_written', 'Bytes written by the process during the stage'),
+        ('rows', 'rca_stage_rows', 'Rows produced or written by the stage'),
+    ]
+    lines = []
+    for field, metric, help_text in metric_fields:
+        lines.append(f'# HELP {metric} {help_text}')
+        lines.append(f'# TYPE {metric} gauge')
+        # Keep the last call of each stage so every series is unique
+        latest = {m['stage']: m for m in run_metrics}
+        for name, metrics in latest.items():
+            if metrics[field] is not None:
+                lines.append(f'{metric}{{stage="{name}",status="{metrics["status"]}"}} {metrics[field]}')
+    # Write through a temp file so the node exporter never reads a partial file
     try:
-        # Create a SharePoint context
+        with open(prometheus_textfile + '.tmp', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(prometheus_textfile + '.tmp', prometheus_textfile)
+    except Exception as e:
+        print(f'An error occurred writing the Prometheus textfile: {e}')
+
+
+# One authenticated SharePoint context shared by every stage. Set _sharepoint_context to
+# a ClientContext for a stand-in server (e.g. with_access_token) to run against a stub.
+_sharepoint_context = None
+# Queued (non-direct) queries share the context's query list, so only one thread may
+# build and execute them at a time
+_sharepoint_lock = threading.Lock()
+# SP.MoveOperations.overwrite
+SHAREPOINT_MOVE_OVERWRITE = 1
+
+
+def get_sharepoint_context():
+    global _sharepoint_context
+    if _sharepoint_context is None:
+        from office365.sharepoint.client_context import ClientContext
+        from office365.runtime.auth.user_credential import UserCredential
         ctx_auth = UserCredential(sharepoint_username, sharepoint_password)
-        ctx = ClientContext(sharepoint_site_url).with_credentials(ctx_auth)
+        _sharepoint_context = ClientContext(sharepoint_site_url).with_credentials(ctx_auth)
+    return _sharepoint_context
+
 
-        # Specify the SharePoint library and folder
-        library_name = "Shared Documents"
-        folder_relative_url = "/sites/NIBSS-ITEXrepo/Shared Documents/RCA_input"
+def list_sharepoint_files(folder_url, properties=('Name', 'ServerRelativeUrl', 'Length')):
+    # The given properties of every file in a folder, in a single round trip
+    ctx = get_sharepoint_context()
+    with _sharepoint_lock:
+        files = ctx.web.get_folder_by_server_relative_url(folder_url).files
+        ctx.load(files, list(properties))
+        ctx.execute_query()
+    return list(files)
+
+
+def download_sharepoint_file(server_relative_url, dest):
+    # Stream one file to dest through a temp file, without queueing on the shared context
+    from office365.runtime.http.request_options import RequestOptions
+    ctx = get_sharepoint_context()
+    quoted = urllib.parse.quote(server_relative_url.replace("'", "''"))
+    request = RequestOptions(f"{ctx.service_root_url}/web/getFileByServerRelativeUrl('{quoted}')/$value")
+    request.stream = True
+    response = ctx.pending_request().execute_request_direct(request)
+    temp_path = dest + '.part'
+    try:
+        with open(temp_path, 'wb') as f:
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+    finally:
+        response.close()
+    os.replace(temp_path, dest)
+
+
+def upload_to_sharepoint(local_path, folder_url, chunk_size=None):
+    # Upload a file in chunks through an upload session. A failed chunk is retried from the
+    # offset the server last acknowledged, so a dropped connection does not restart the file.
+    chunk_size = chunk_size or sharepoint_upload_chunk_size
+    ctx = get_sharepoint_context()
+    file_name = os.path.basename(local_path)
+    file_size = os.path.getsize(local_path)
+
+    with _sharepoint_lock, open(local_path, 'rb') as f:
+        folder = ctx.web.get_folder_by_server_relative_url(folder_url)
+        if file_size <= chunk_size:
+            folder.files.add(file_name, f.read(), True)
+            ctx.execute_query()
+            return
 
-        # Get the folder by its server relative URL
-        folder = ctx.web.get_folder_by_server_relative_url(folder_relative_url)
-        ctx.load(folder)
+        target = folder.files.add(file_name, None, True)
         ctx.execute_query()
+        upload_id = str(uuid.uuid4())
+        offset = 0
+        while offset < file_size:
+            f.seek(offset)
+            content = f.read(chunk_size)
+            for attempt in range(sharepoint_upload_retries):
+                try:
+                    if offset + len(content) >= file_size:
+                        target.finish_upload(upload_id, offset, content)
+                        ctx.execute_query()
+                        offset = file_size
+                    else:
+                        if offset == 0:
+                            result = target.start_upload(upload_id, content)
+                        else:
+                            result = target.continue_upload(upload_id, offset, content)
+                        ctx.execute_query()
+                        offset = int(result.value)
+                    break
+                except Exception as e:
+                    # The failed query is already off the queue, so the chunk can be resent
+                    if attempt == sharepoint_upload_retries - 1:
+                        try:
+                            target.cancel_upload(upload_id)
+                            ctx.execute_query()
+                        except Exception:
+                            pass
+                        raise
+                    print(f'Upload of {file_name} failed at byte {offset}, retrying: {e}')
+                    time.sleep(download_backoff ** attempt)
+
+
+def move_sharepoint_files(files, folder_url):
+    # Server-side move of the given files into folder_url, sent as one batch request;
+    # the file contents never pass through this host
+    from office365.runtime.queries.service_operation import ServiceOperationQuery
+    ctx = get_sharepoint_context()
+    with _sharepoint_lock:
+        for file in files:
+            source = ctx.web.get_file_by_server_relative_url(file.properties['ServerRelativeUrl'])
+            new_url = '/'.join([folder_url.rstrip('/'), file.properties['Name']])
+            params = {'newurl': new_url, 'flags': SHAREPOINT_MOVE_OVERWRITE}
+            ctx.add_query(ServiceOperationQuery(source, 'moveto', params))
+        ctx.execute_batch()
 
+
+@stage
+def retrieve_rca_from_sharepoint():
+    try:
         # Check if the folder is empty
-        files = folder.files
-        ctx.load(files)
-        ctx.execute_query()
-        
-        if not files or len(files) == 0:
+        files = list_sharepoint_files(sharepoint_input_folder)
+        if len(files) == 0:
             print("The 'RCA_input' folder is empty. No files to download.")
             return
 
@@ -68,68 +453,643 @@ def retrieve_rca_from_sharepoint():
         if not os.path.exists(inputrca_loc):
             os.makedirs(inputrca_loc)
 
-        # Iterate through files and download them
-        for file in files:
+        # Download the files concurrently over the shared context
+        def download(file):
             file_name = file.properties['Name']
-            local_file_path = os.path.join(inputrca_loc, file_name)
+            download_sharepoint_file(file.properties['ServerRelativeUrl'], os.path.join(inputrca_loc, file_name))
+            return file_name
 
-            with open(local_file_path, "wb") as local_file:
-                file.download(local_file)
-                ctx.execute_query()
+        with ThreadPoolExecutor(max_workers=sharepoint_download_workers) as pool:
+            for file_name in pool.map(download, files):
                 print(f"Downloaded: {file_name}")
 
         print('Raw RCA downloaded successfully.')
 
     except Exception as e:
-        print(f"An error occurred: {e}")
-
-
-def get_recent_date():
-    # Connect to vas transactions in Mongodb to collect last date
-    host = config_mongo["HOST"]
-    port = config_mongo["PORT"]
-    user_name = config_mongo["USERNAME"]
-    pass_word = config_mongo["PASSWORD"]
-    db_name = config_mongo["DATABASE"]
-    client = MongoClient(f'mongodb://{user_name}:{urllib.parse.quote_plus(pass_word)}@{host}:{port}/{db_name}')
-    db = client['eftEngine']
-    today = datetime.now()
-    start = today - timedelta(days=30)
-    
-    pipeline = [
-        {
-            "$match": {
-                "updatedAt": {"$gte": start, "$lt": today}
-            }
-        },
-        {
-            "$group": {
-                "_id": "$terminalId",
-                "latest_date": {"$max": "$updatedAt"}
-            }
-        },
-        {
-            "$project": {
-                "_id": 0,
-                "terminalId": "$_id",
-                "latest_date": 1
-            }
-        }
-    ]
+        print(f"An error occurred downloading raw RCA files: {e}")
+        raise
+
+
+# Index the VAS journal aggregation hints at
+JOURNAL_INDEX = [('updatedAt', 1), ('terminalId', 1)]
+# Timestamp format of the watermark in the latest date cache
+DATE_CACHE_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+_mongo_client = None
+
+
+def get_mongo_client():
+    # One pooled client per process instead of a new connection per call
+    global _mongo_client
+    if _mongo_client is None:
+        from pymongo import MongoClient
+        host = config_mongo["HOST"]
+        port = config_mongo["PORT"]
+        user_name = config_mongo["USERNAME"]
+        pass_word = config_mongo["PASSWORD"]
+        db_name = config_mongo["DATABASE"]
+        _mongo_client = MongoClient(
+            f'mongodb://{user_name}:{urllib.parse.quote_plus(pass_word)}@{host}:{port}/{db_name}',
+            maxPoolSize=config_mongo.get('MAX_POOL_SIZE', 10),
+        )
+    return _mongo_client
+
+
+def journal_collections(db, start):
+    # Names of the journal collections that can hold documents updated since start
+    if not mongo_collection_pattern:
+        return [mongo_collection]
+
+    dated = []
+    for name in db.list_collection_names():
+        try:
+            dated.append((datetime.strptime(name, mongo_collection_pattern), name))
+        except ValueError:
+            continue
+    dated.sort()
+    # A collection holds journals from its own date until the next one starts, so keep
+    # the last collection that starts before the window as well
+    older = [name for day, name in dated if day <= start]
+    newer = [name for day, name in dated if day > start]
+    return older[-1:] + newer
 
-    # Sort the result by terminal if needed
-    # pipeline.append({"$sort": {"terminal": 1}})
-    print('Processing dates from VAS')
-    result = list(db.journals_24_01_03.aggregate(pipeline))
 
-    # Convert the list of dictionaries to a pandas DataFrame
-    df = pd.DataFrame(result)
+def ensure_journal_index(collection):
+    # Create the (updatedAt, terminalId) index the aggregation hints at
+    collection.create_index(JOURNAL_INDEX, name='updatedAt_1_terminalId_1', background=True)
+
+
+def has_journal_index(collection):
+    return any(list(index['key']) == JOURNAL_INDEX for index in collection.index_information().values())
+
+
+@stage
+def get_recent_date(terminal_ids=None, start=None, end=None):
+    # Collect the last transaction date per terminal from VAS transactions in Mongodb.
+    # When terminal_ids is given the aggregation is narrowed to those terminals, in
+    # batches of $in lists. The (updatedAt, terminalId) index covers the whole pipeline.
+    db = get_mongo_client()['eftEngine']
+    end = end or datetime.now()
+    start = start or end - timedelta(days=mongo_lookback_days)
+
+    if terminal_ids is None:
+        id_batches = [None]
+    else:
+        ids = list(build_terminal_index(terminal_ids))
+        id_batches = [ids[i:i + mongo_in_batch] for i in range(0, len(ids), mongo_in_batch)]
+
+    collections = journal_collections(db, start)
+    print('Processing dates from VAS')
+    terminals, dates = [], []
+    for name in collections:
+        collection = db[name]
+        options = {'allowDiskUse': True, 'batchSize': mongo_cursor_batch}
+        if config_mongo.get('CREATE_INDEX'):
+            ensure_journal_index(collection)
+        if has_journal_index(collection):
+            options['hint'] = JOURNAL_INDEX
+
+        for batch in id_batches:
+            match = {"updatedAt": {"$gte": start, "$lt": end}}
+            if batch is not None:
+                match["terminalId"] = {"$in": batch}
+            pipeline = [
+                {"$match": match},
+                {"$group": {"_id": "$terminalId", "latest_date": {"$max": "$updatedAt"}}},
+            ]
+            # Stream the cursor straight into columns rather than a list of dicts
+            for doc in collection.aggregate(pipeline, **options):
+                terminals.append(doc['_id'])
+                dates.append(doc['latest_date'])
+
+    df = pd.DataFrame({'latest_date': pd.Series(dates, dtype='datetime64[ns]'),
+                       'terminalId': pd.Series(terminals, dtype=object)})
+    if len(collections) > 1:
+        # The same terminal can appear in several collections; keep its latest date
+        df = df.groupby('terminalId', sort=False, as_index=False)['latest_date'].max()
+        df = df[['latest_date', 'terminalId']]
     print('Dates obtained from VAS')
 
     return df
 
 
-def transform_file():
+def open_date_cache():
+    conn = sqlite3.connect(date_cache_path)
+    conn.execute('CREATE TABLE IF NOT EXISTS latest_dates (terminalId TEXT PRIMARY KEY, latest_date TEXT NOT NULL)')
+    conn.execute('CREATE TABLE IF NOT EXISTS cache_meta (key TEXT PRIMARY KEY, value TEXT)')
+    return conn
+
+
+def read_watermark(conn):
+    row = conn.execute("SELECT value FROM cache_meta WHERE key = 'watermark'").fetchone()
+    return datetime.strptime(row[0], DATE_CACHE_FORMAT) if row else None
+
+
+def merge_into_date_cache(conn, latest_date_df, watermark, start):
+    # Merge newly aggregated dates into the cache keeping the max per terminal, move the
+    # watermark and prune terminals whose last date has left the lookback window
+    rows = [
+        (tid, ts.strftime(DATE_CACHE_FORMAT))
+        for tid, ts in zip(latest_date_df['terminalId'], latest_date_df['latest_date'])
+        if tid is not None and not pd.isna(ts)
+    ]
+    with conn:
+        conn.executemany(
+            'INSERT INTO latest_dates (terminalId, latest_date) VALUES (?, ?) '
+            'ON CONFLICT(terminalId) DO UPDATE SET latest_date = max(latest_date, excluded.latest_date)',
+            rows
+        )
+        conn.execute(
+            "INSERT INTO cache_meta (key, value) VALUES ('watermark', ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (watermark.strftime(DATE_CACHE_FORMAT),)
+        )
+        conn.execute('DELETE FROM latest_dates WHERE latest_date < ?', (start.strftime(DATE_CACHE_FORMAT),))
+
+
+def read_date_cache(conn, start, terminal_ids=None):
+    # Cached latest dates inside the lookback window, in the get_recent_date() layout
+    df = pd.read_sql_query(
+        'SELECT latest_date, terminalId FROM latest_dates WHERE latest_date >= ?',
+        conn, params=(start.strftime(DATE_CACHE_FORMAT),)
+    )
+    df['latest_date'] = pd.to_datetime(df['latest_date'], format=DATE_CACHE_FORMAT)
+    if terminal_ids is not None:
+        df = df[in_terminal_index(df['terminalId'], build_terminal_index(terminal_ids))]
+    return df.reset_index(drop=True)
+
+
+def rebuild_date_cache():
+    # Full rebuild: aggregate the whole lookback window for every terminal
+    end = datetime.now()
+    start = end - timedelta(days=mongo_lookback_days)
+    print('Rebuilding the latest date cache')
+    latest_date_df = get_recent_date(start=start, end=end)
+    conn = open_date_cache()
+    try:
+        with conn:
+            conn.execute('DELETE FROM latest_dates')
+        merge_into_date_cache(conn, latest_date_df, end, start)
+    finally:
+        conn.close()
+    print(f'Latest date cache rebuilt with {len(latest_date_df)} terminals')
+
+
+def get_cached_recent_date(terminal_ids=None):
+    # Latest date per terminal from the cache, after aggregating only the journals newer
+    # than the watermark (less a small overlap for late writes). The cache covers every
+    # terminal, so it stays complete when new terminals get registered.
+    end = datetime.now()
+    start = end - timedelta(days=mongo_lookback_days)
+    conn = open_date_cache()
+    try:
+        watermark = read_watermark(conn)
+        if watermark is None or watermark < start:
+            conn.close()
+            rebuild_date_cache()
+            conn = open_date_cache()
+        else:
+            print(f'Aggregating journals since {watermark - watermark_overlap}')
+            delta_df = get_recent_date(start=watermark - watermark_overlap, end=end)
+            merge_into_date_cache(conn, delta_df, end, start)
+        return read_date_cache(conn, start, terminal_ids)
+    finally:
+        conn.close()
+
+
+def check_date_cache(terminal_ids=None):
+    # Compare the cache with a full aggregation of the lookback window and report any
+    # terminal whose date differs or is missing on either side. The aggregation stops at
+    # the cache's watermark, since journals written after it are not in the cache yet.
+    conn = open_date_cache()
+    try:
+        end = read_watermark(conn) or datetime.now()
+        start = end - timedelta(days=mongo_lookback_days)
+        cached_df = read_date_cache(conn, start, terminal_ids)
+    finally:
+        conn.close()
+    full_df = get_recent_date(terminal_ids, start=start, end=end)
+
+    merged = full_df.merge(cached_df, on='terminalId', how='outer', suffixes=('_full', '_cached'))
+    mismatched = merged[merged['latest_date_full'] != merged['latest_date_cached']]
+    if len(mismatched):
+        print(f'Latest date cache differs from a full aggregation for {len(mismatched)} terminals')
+    else:
+        print(f'Latest date cache matches a full aggregation ({len(full_df)} terminals)')
+    return mismatched
+
+
+def get_latest_dates(terminal_ids):
+    # Latest transaction dates of the given terminals, from the cache when it is enabled
+    if date_cache_enabled:
+        return get_cached_recent_date(terminal_ids)
+    return get_recent_date(terminal_ids)
+
+
+def build_terminal_index(terminal_ids):
+    # Hashed, de-duplicated index of terminal IDs, built once per run so that
+    # membership tests are O(1) instead of a scan of the whole array per row
+    return pd.Index(pd.Series(terminal_ids).dropna().unique())
+
+
+def build_latest_date_lookup(latest_date_df):
+    # Series of latest transaction dates keyed by terminal ID. Its index doubles as
+    # the membership index of active terminals.
+    if latest_date_df.empty or 'terminalId' not in latest_date_df.columns:
+        return pd.Series(dtype='datetime64[ns]')
+    latest = latest_date_df.dropna(subset=['terminalId']).drop_duplicates('terminalId')
+    return latest.set_index('terminalId')['latest_date']
+
+
+def in_terminal_index(terminal_ids, terminal_index):
+    # Boolean mask of which terminal ids are in the index, resolved through the
+    # index's hash table rather than a per-value isin scan
+    return terminal_index.get_indexer(pd.Index(terminal_ids)) >= 0
+
+
+# Typed schema of the RCA frame: compact strings (Arrow-backed when pyarrow is installed),
+# categorical status flags and one datetime column. Built on first use, with pandas.
+@functools.lru_cache(maxsize=None)
+def rca_dtypes():
+    has_pyarrow = importlib.util.find_spec('pyarrow') is not None
+    return {
+        'string': pd.StringDtype('pyarrow') if has_pyarrow else pd.StringDtype(),
+        'CONNECTED': pd.CategoricalDtype(['NO', 'YES']),
+        'STATUS': pd.CategoricalDtype(['INACTIVE', 'ACTIVE']),
+    }
+
+
+RCA_STRING_COLUMNS = ['Terminal_ID', 'Merchant_Name', 'Terminal_Owner', 'terminalId']
+
+
+def flag_column(mask, dtype):
+    # Categorical column from a boolean mask: False maps to the first category
+    return pd.Categorical.from_codes(pd.Series(mask).to_numpy().astype('int8'), dtype=dtype)
+
+
+def parse_dates(series):
+    # One vectorized parse; values that are not dates become NaT
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return series
+    return pd.to_datetime(series, errors='coerce')
+
+
+def apply_rca_schema(df):
+    # Cast an RCA frame (freshly classified or read back from a file) to the typed schema
+    df = df.copy()
+    for col in RCA_STRING_COLUMNS:
+        if col in df.columns:
+            df[col] = df[col].astype(rca_dtypes()['string'])
+    if 'CONNECTED' in df.columns:
+        df['CONNECTED'] = df['CONNECTED'].astype(rca_dtypes()['CONNECTED'])
+    if 'STATUS' in df.columns:
+        df['STATUS'] = df['STATUS'].astype(rca_dtypes()['STATUS'])
+    if 'LAST_TRANSACTION_DATE' in df.columns:
+        df['LAST_TRANSACTION_DATE'] = parse_dates(df['LAST_TRANSACTION_DATE'])
+    return df
+
+
+def prepare_rca_for_db(df):
+    # Typed RCA frame with LAST_TRANSACTION_DATE as the date text stored in RCA_table
+    df = apply_rca_schema(df)
+    df['LAST_TRANSACTION_DATE'] = df['LAST_TRANSACTION_DATE'].dt.strftime('%Y-%m-%d')
+    return df
+
+
+def classify_terminals(reg_df, connected_ids, latest_date_df):
+    # Pure function: takes the registered terminals, the connected terminal IDs and
+    # the latest dates from VAS, and returns the classified registered terminals
+    reg_df = reg_df.copy()
+    connected_index = build_terminal_index(connected_ids)
+    latest_dates = build_latest_date_lookup(latest_date_df)
+
+    # Update the 'CONNECTED' column based on whether the terminal is in the connected sheet
+    is_connected = pd.Series(in_terminal_index(reg_df['Terminal_ID'], connected_index), index=reg_df.index)
+    reg_df['CONNECTED'] = flag_column(is_connected, rca_dtypes()['CONNECTED'])
+
+    # Update the 'STATUS' column based on if the terminal id has a recent transaction
+    is_active = pd.Series(in_terminal_index(reg_df['Terminal_ID'], latest_dates.index), index=reg_df.index)
+    reg_df['STATUS'] = flag_column(is_active, rca_dtypes()['STATUS'])
+
+    # Keep the matched VAS terminal id column the old merge used to add
+    reg_df['terminalId'] = reg_df['Terminal_ID'].where(is_active)
+
+    # Rename 'LastSeenDate' to 'LAST_TRANSACTION_DATE'
+    reg_df.rename(columns={'LastSeenDate': 'LAST_TRANSACTION_DATE'}, inplace=True)
+
+    # Replace 'LAST_TRANSACTION_DATE' with the value from VAS where it's not null
+    recent = reg_df['Terminal_ID'].map(latest_dates)
+    reg_df['LAST_TRANSACTION_DATE'] = parse_dates(recent).combine_first(parse_dates(reg_df['LAST_TRANSACTION_DATE']))
+
+    return apply_rca_schema(reg_df)
+
+
+# Sheets and columns of the NIBSS RCA workbook the pipeline actually uses
+REGISTERED_SHEET = 'REGISTERED TERMINALS'
+CONNECTED_SHEET = 'CONNECTED TERMINALS'
+REGISTERED_USECOLS = ['Terminal_ID', 'Merchant_Name', 'Terminal_Owner', 'LastSeenDate']
+CONNECTED_USECOLS = ['Terminal_ID']
+RCA_CHUNK_SIZE = 100000
+
+
+def iter_sheet_chunks(raw_rca_path, sheet_name, columns, chunk_size=RCA_CHUNK_SIZE):
+    # Stream one sheet of the RCA workbook as dataframes of at most chunk_size rows,
+    # keeping only the requested columns. xlsx files are read with openpyxl in
+    # read-only mode so rows are parsed lazily; other formats fall back to read_excel.
+    if not raw_rca_path.lower().endswith(('.xlsx', '.xlsm')):
+        df = pd.read_excel(raw_rca_path, sheet_name=sheet_name, usecols=columns)
+        for start in range(0, len(df), chunk_size):
+            yield df.iloc[start:start + chunk_size][columns]
+        return
+
+    import openpyxl
+    workbook = openpyxl.load_workbook(raw_rca_path, read_only=True, data_only=True)
+    try:
+        rows = workbook[sheet_name].iter_rows(values_only=True)
+        header = next(rows, None) or ()
+        positions = {}
+        for i, name in enumerate(header):
+            positions.setdefault(name, i)
+        missing = [col for col in columns if col not in positions]
+        if missing:
+            raise KeyError(f"'{sheet_name}' is missing columns: {missing}")
+        indexes = [positions[col] for col in columns]
+
+        chunk = []
+        for row in rows:
+            values = [row[i] if i < len(row) else None for i in indexes]
+            if all(value is None for value in values):
+                continue
+            chunk.append(values)
+            if len(chunk) >= chunk_size:
+                yield pd.DataFrame(chunk, columns=columns)
+                chunk = []
+        if chunk:
+            yield pd.DataFrame(chunk, columns=columns)
+    finally:
+        workbook.close()
+
+
+def read_rca_workbook(raw_rca_path, chunk_size=RCA_CHUNK_SIZE):
+    # Load the registered terminals (projected to the columns we keep) and the index of
+    # connected terminal IDs from the raw RCA workbook. Memory is not flat: the whole
+    # registered frame is needed downstream, the chunks and the frame built from them
+    # briefly coexist in the final concat, and openpyxl holds the workbook's shared
+    # strings for the whole read, which is the larger part of the peak. Concatenating
+    # chunk by chunk copies the growing frame on every chunk without lowering that peak.
+    reg_chunks = list(iter_sheet_chunks(raw_rca_path, REGISTERED_SHEET, REGISTERED_USECOLS, chunk_size))
+    if reg_chunks:
+        reg_df = pd.concat(reg_chunks, ignore_index=True)
+    else:
+        reg_df = pd.DataFrame(columns=REGISTERED_USECOLS)
+
+    connected_index = pd.Index([])
+    for chunk in iter_sheet_chunks(raw_rca_path, CONNECTED_SHEET, CONNECTED_USECOLS, chunk_size):
+        connected_index = connected_index.append(build_terminal_index(chunk['Terminal_ID'])).unique()
+
+    return reg_df, connected_index
+
+
+class RCAValidationError(Exception):
+    # A raw RCA file that fails the up-front checks. It stops the run before the VAS
+    # aggregation or any write, instead of being printed and skipped like a fetch error.
+    pass
+
+
+RCA_REQUIRED_COLUMNS = {REGISTERED_SHEET: REGISTERED_USECOLS, CONNECTED_SHEET: CONNECTED_USECOLS}
+
+
+def rca_sheet_headers(raw_rca_path):
+    # Header row of every sheet of a workbook, without parsing the data rows
+    if not raw_rca_path.lower().endswith(('.xlsx', '.xlsm')):
+        sheets = pd.read_excel(raw_rca_path, sheet_name=None, nrows=0)
+        return {name: list(df.columns) for name, df in sheets.items()}
+
+    import openpyxl
+    workbook = openpyxl.load_workbook(raw_rca_path, read_only=True, data_only=True)
+    try:
+        return {name: list(next(workbook[name].iter_rows(max_row=1, values_only=True), ()))
+                for name in workbook.sheetnames}
+    finally:
+        workbook.close()
+
+
+def validate_rca_headers(raw_rca_path):
+    # Check that the sheets and columns the pipeline reads are all there. A missing one is
+    # reported with the closest name found, which is usually the same column renamed.
+    name = os.path.basename(raw_rca_path)
+    try:
+        headers = rca_sheet_headers(raw_rca_path)
+    except Exception as e:
+        raise RCAValidationError(f'{name} is not a readable workbook: {e}')
+
+    problems = []
+    for sheet, columns in RCA_REQUIRED_COLUMNS.items():
+        if sheet not in headers:
+            close = difflib.get_close_matches(sheet, list(headers), n=1)
+            problems.append(f"missing sheet '{sheet}'" + (f" (found '{close[0]}')" if close else ''))
+            continue
+        present = [str(col) for col in headers[sheet] if col is not None]
+        for col in columns:
+            if col not in present:
+                close = difflib.get_close_matches(col, present, n=1)
+                problems.append(f"'{sheet}' is missing column '{col}'" + (f" (found '{close[0]}')" if close else ''))
+    if problems:
+        raise RCAValidationError(f"{name} rejected: {'; '.join(problems)}")
+
+
+def dedup_terminals(reg_df):
+    # Vectorized dedup of the registered terminals. Rows without a Terminal_ID are dropped
+    # and repeated rows collapsed. IDs repeated with different details are conflicts: they
+    # are written to CONFLICT_REPORT and resolved to the row with the latest LastSeenDate.
+    # More conflicting IDs than MAX_CONFLICT_SHARE of the terminals rejects the file.
+    ids = reg_df['Terminal_ID']
+    blank = (ids.isna() | (ids.astype(str).str.strip() == '')).to_numpy()
+    df = reg_df[~blank]
+    repeated_rows = df.duplicated(keep='first').to_numpy()
+    df = df[~repeated_rows]
+    if df.empty:
+        raise RCAValidationError(f"'{REGISTERED_SHEET}' has no terminals")
+
+    repeated = df['Terminal_ID'].duplicated(keep=False).to_numpy()
+    conflicts = df[repeated]
+    conflict_ids = conflicts['Terminal_ID'].nunique()
+    if conflict_ids:
+        try:
+            conflicts.sort_values('Terminal_ID', kind='stable').to_csv(conflict_report_path, index=False)
+        except Exception as e:
+            print(f'An error occurred writing the conflict report: {e}')
+        terminals = df['Terminal_ID'].nunique()
+        if max_conflict_share is not None and conflict_ids > max_conflict_share * terminals:
+            raise RCAValidationError(
+                f'{conflict_ids} of {terminals} terminals are listed with conflicting details, '
+                f'over the MAX_CONFLICT_SHARE of {max_conflict_share:.1%}; see {conflict_report_path}')
+        seen = parse_dates(df['LastSeenDate'])
+        df = (df.assign(_seen=seen).sort_values('_seen', kind='stable', na_position='first')
+                .drop_duplicates('Terminal_ID', keep='last').sort_index().drop(columns='_seen'))
+
+    print(f'{len(df)} registered terminals: {int(blank.sum())} rows without an ID and '
+          f'{int(repeated_rows.sum())} repeated rows dropped, {conflict_ids} conflicting IDs resolved')
+    return df.reset_index(drop=True)
+
+
+def previous_row_count(db_path):
+    # Rows of RCA_table in the previously published database, None when there is none
+    if not db_path or not os.path.exists(db_path):
+        return None
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute('SELECT COUNT(*) FROM RCA_table').fetchone()[0]
+    except sqlite3.Error:
+        return None
+    finally:
+        conn.close()
+
+
+def check_row_drift(rows, previous_rows):
+    # Reject an RCA whose terminal count moved too far from the published RCA_table, in
+    # either direction: a truncated export or a different file is far more likely than a
+    # fleet that shrank or grew that much in a day
+    if not previous_rows:
+        return
+    drift = (rows - previous_rows) / previous_rows
+    limit = max_row_drop if drift < 0 else max_row_growth
+    limit_name = 'MAX_ROW_DROP' if drift < 0 else 'MAX_ROW_GROWTH'
+    if limit is not None and abs(drift) > limit:
+        raise RCAValidationError(
+            f'{rows} registered terminals against {previous_rows} in the published RCA_table '
+            f'({drift:+.1%}), over the {limit_name} of {limit:.0%}')
+    print(f'Row count drift {drift:+.1%} against the published RCA_table')
+
+
+def read_validated_rca(raw_rca_path, chunk_size=RCA_CHUNK_SIZE):
+    # read_rca_workbook with the header check first and the registered terminals deduped
+    validate_rca_headers(raw_rca_path)
+    reg_df, connected_ids = read_rca_workbook(raw_rca_path, chunk_size)
+    return dedup_terminals(reg_df), connected_ids
+
+
+# Background threads writing the processed xlsx export
+_export_threads = []
+
+
+def write_checkpoint(reg_df):
+    try:
+        os.makedirs(rca_loc, exist_ok=True)
+        reg_df.to_parquet(os.path.join(rca_loc, 'processed_rca.parquet'), index=False)
+        print(f'Processed RCA checkpoint written to {rca_loc}')
+    except Exception as ex:
+        print(f'An error occurred writing the processed RCA checkpoint: {ex}')
+
+
+def export_xlsx_in_background(reg_df):
+    def export():
+        try:
+            os.makedirs(rca_loc, exist_ok=True)
+            xlsx_path = os.path.join(rca_loc, 'processed_rca.xlsx')
+            reg_df.to_excel(xlsx_path, index=False, engine='xlsxwriter')
+            print(f'Processed RCA file loaded to {rca_loc}')
+            if sharepoint_processed_folder:
+                upload_to_sharepoint(xlsx_path, sharepoint_processed_folder)
+                print(f'Processed RCA file uploaded to {sharepoint_processed_folder}')
+        except Exception as ex:
+            print(f'An error occurred in building the processed excel file: {ex}')
+
+    thread = threading.Thread(target=export, name='processed-rca-export')
+    thread.start()
+    _export_threads.append(thread)
+
+
+def wait_for_exports():
+    # Block until background exports finish, before their files are archived or removed
+    while _export_threads:
+        _export_threads.pop().join()
+
+
+@stage
+def load_rca_inputs(previous_db_ready=None):
+    # Download the raw RCA, check and read it, then aggregate VAS dates for its registered
+    # terminals only. Returns None when there is not exactly one raw RCA file to process.
+    # previous_db_ready is set once the published database is downloaded, which the row
+    # count drift check needs.
+    retrieve_rca_from_sharepoint()
+    raw_files = pending_rca_files()
+    # Reject a malformed file in milliseconds, before it is read or aggregated
+    for path in raw_files:
+        validate_rca_headers(path)
+    if len(raw_files) != 1:
+        return None
+    reg_df, connected_ids = read_rca_workbook(raw_files[0])
+    reg_df = dedup_terminals(reg_df)
+    if previous_db_ready is not None:
+        previous_db_ready.wait()
+    check_row_drift(len(reg_df), previous_row_count(local_db_path))
+    latest_date_df = get_latest_dates(reg_df['Terminal_ID'])
+    return {'reg_df': reg_df, 'connected_ids': connected_ids, 'latest_dates': latest_date_df}
+
+
+# Dates in raw RCA file names, e.g. 'RCA_2024-01-03.xlsx' or 'RCA 03-01-2024.xlsx'
+RCA_FILE_DATE_PATTERNS = [
+    (re.compile(r'(\d{4})[-_.]?(\d{2})[-_.]?(\d{2})'), ('%Y', '%m', '%d')),
+    (re.compile(r'(\d{2})[-_.](\d{2})[-_.](\d{4})'), ('%d', '%m', '%Y')),
+]
+
+
+def rca_file_date(path):
+    # Date of a raw RCA file from its name, falling back to its modification time
+    name = os.path.basename(path)
+    for pattern, formats in RCA_FILE_DATE_PATTERNS:
+        match = pattern.search(name)
+        if match:
+            try:
+                return datetime.strptime(' '.join(match.groups()), ' '.join(formats))
+            except ValueError:
+                continue
+    return datetime.fromtimestamp(os.path.getmtime(path))
+
+
+def pending_rca_files():
+    # Raw RCA files waiting in inputrca_loc, oldest first
+    if not os.path.exists(inputrca_loc):
+        return []
+    paths = [inputrca_loc + name for name in os.listdir(inputrca_loc)]
+    return sorted(paths, key=lambda path: (rca_file_date(path), path))
+
+
+def parse_rca_batch(paths, workers=None):
+    # Read several raw RCA workbooks in parallel, one process per file up to workers
+    workers = min(workers or batch_workers, len(paths))
+    if workers <= 1:
+        return [read_rca_workbook(path) for path in paths]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(read_rca_workbook, paths))
+
+
+@stage
+def transform_batch(paths=None):
+    # Fold a backlog of raw RCA files into one state update. Processing the files one run
+    # at a time leaves RCA_table holding the newest file, and stamps the terminals of
+    # every older file into the legacy dates on the way. So the newest file is classified
+    # as usual, and the terminals of the older files are returned for update_legacy.
+    paths = paths or pending_rca_files()
+    for path in paths:
+        validate_rca_headers(path)
+    print(f'Processing {len(paths)} raw RCA files in a batch')
+    parsed = parse_rca_batch(paths)
+    print('Raw RCA files loaded')
+
+    reg_df, connected_ids = parsed[-1]
+    reg_df = dedup_terminals(reg_df)
+    check_row_drift(len(reg_df), previous_row_count(local_db_path))
+    latest_date_df = get_latest_dates(reg_df['Terminal_ID'])
+    processed_df = classify_terminals(reg_df, connected_ids, latest_date_df)
+
+    older_ids = build_terminal_index(pd.concat([older['Terminal_ID'] for older, _ in parsed[:-1]], ignore_index=True))
+    return processed_df, older_ids
+
+
+@stage
+def transform_file(rca_inputs=None):
     if len(os.listdir(inputrca_loc)) == 0:
         print('No Available Raw RCA File')
         return
@@ -139,465 +1099,1510 @@ def transform_file():
     else: 
         for rawfile in os.listdir(inputrca_loc):
             raw_rca_path = inputrca_loc + rawfile
-            rca_df = pd.read_excel(raw_rca_path, sheet_name=None) # Read in the RCA file and convert to pandas dataframe
-            
-            print('Raw RCA file loaded')
             try:
-                # Break up the excel tabs into different dataframes
-                reg_df = rca_df['REGISTERED TERMINALS']
-                connected_df = rca_df['CONNECTED TERMINALS']
-
-                # Deleting irrelevant columns from reg_df
-                del reg_df['Merchant_ID']
-                del reg_df['Bank']
-                del reg_df['MCC']
-                del reg_df['ptsp_code']
-                del reg_df['PTSP']
-                del reg_df['Merchant_Account_No']
-                del reg_df['AccountNo']
-                del reg_df['Registered_Date']
-                del reg_df['ConnectDate']
-                del reg_df['Contact']
-                del reg_df['Address']
-                del reg_df['Phone']
-                del reg_df['State']
+                if rca_inputs is not None:
+                    # Already read and aggregated by the fetch stage
+                    reg_df = rca_inputs['reg_df']
+                    connected_ids = rca_inputs['connected_ids']
+                    latest_date_df = rca_inputs['latest_dates']
+                else:
+                    # Read only the two sheets and the columns the pipeline uses
+                    reg_df, connected_ids = read_validated_rca(raw_rca_path)
+                    check_row_drift(len(reg_df), previous_row_count(local_db_path))
+
+                    # Get the latest dates of the registered terminals
+                    latest_date_df = get_latest_dates(reg_df['Terminal_ID'])
+                print('Raw RCA file loaded')
 
                 print('Transforming dataframe')
-                
-                # Update the 'CONNECTED' column based on conditions
-                reg_df['CONNECTED'] = reg_df['Terminal_ID'].apply(
-                    lambda tid: 'YES' if tid in connected_df['Terminal_ID'].values else 'NO'
-                )
-
-                # Get the latest_date DataFrame using get_recent_date function
-                latest_date_df = get_recent_date()
-                
-                # Update the 'STATUS' column based on if the terminal id is in latest_date_df
-                reg_df['STATUS'] = reg_df['Terminal_ID'].apply(
-                    lambda stat: 'ACTIVE' if stat in latest_date_df['terminalId'].values else 'INACTIVE'
-                )
-
-                # Merge the latest_date data into reg_df based on 'Terminal_ID' and 'terminal'
-                reg_df = reg_df.merge(latest_date_df, left_on='Terminal_ID', right_on='terminalId', how='left')
 
-                # Rename 'LastSeenDate' to 'LAST_TRANSACTION_DATE'
-                reg_df.rename(columns={'LastSeenDate': 'LAST_TRANSACTION_DATE'}, inplace=True)
-
-                # Replace 'LAST_TRANSACTION_DATE' with the value from 'latest_date' where it's not null
-                reg_df['LAST_TRANSACTION_DATE'] = reg_df['latest_date'].combine_first(reg_df['LAST_TRANSACTION_DATE'])
-
-
-                # Drop the 'latest_date' column as it's no longer needed
-                reg_df.drop('latest_date', axis=1, inplace=True)
+                # Set CONNECTED, STATUS and LAST_TRANSACTION_DATE from the terminal indexes
+                reg_df = classify_terminals(reg_df, connected_ids, latest_date_df)
 
+            except RCAValidationError:
+                raise
             except Exception as dataframeException:
                 print(f'An error occurred in processing dataframe: {dataframeException}')
+                raise
+
+            if checkpoint_processed_rca:
+                write_checkpoint(reg_df)
+            if export_processed_xlsx:
+                export_xlsx_in_background(reg_df)
+
+            # Hand the frame straight to the database stage
+            return reg_df
+
+
+_http_session = None
+
+
+def get_http_session():
+    # One pooled session per process, so repeated downloads reuse connections
+    global _http_session
+    if _http_session is None:
+        import requests
+        _http_session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=8)
+        _http_session.mount('http://', adapter)
+        _http_session.mount('https://', adapter)
+    return _http_session
+
+
+# Set when a run fails part way, so the downloads still in flight stop at the next chunk
+_abort_downloads = threading.Event()
+
+
+class DownloadAborted(Exception):
+    pass
+
+
+def download_file(url, dest_path, timeout=None, retries=None, backoff=None):
+    # Stream url into dest_path in chunks through a temp file that is renamed into place
+    # once complete. The ETag/Last-Modified of each download are kept next to the file
+    # and sent back on the next call, so an unchanged file is not downloaded again.
+    # Failed attempts are retried with exponential backoff, resuming the partial temp
+    # file with a Range request when the server supports it.
+    # Returns True if the file was downloaded, False if the local copy is current.
+    import requests
+    timeout = download_timeout if timeout is None else timeout
+    retries = download_retries if retries is None else retries
+    backoff = download_backoff if backoff is None else backoff
+    session = get_http_session()
+    meta_path = dest_path + '.meta.json'
+    # Per process, so concurrent runs downloading into the same cache do not share a file
+    tmp_path = f'{dest_path}.{os.getpid()}.part'
+
+    headers = {}
+    if os.path.exists(dest_path) and os.path.exists(meta_path):
+        with open(meta_path) as meta_file:
+            meta = json.load(meta_file)
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+    received = 0
+    validator = None
+    for attempt in range(retries + 1):
+        request_headers = dict(headers)
+        if received and validator:
+            request_headers['Range'] = f'bytes={received}-'
+            request_headers['If-Range'] = validator
+        try:
+            if _abort_downloads.is_set():
+                raise DownloadAborted(url)
+            with session.get(url, headers=request_headers, stream=True, timeout=timeout) as response:
+                if response.status_code == 304:
+                    return False
+                if response.status_code not in (200, 206):
+                    error = Exception(response.status_code)
+                    if response.status_code < 500 and response.status_code != 429:
+                        raise error
+                    raise requests.exceptions.RetryError(error)
+
+                if response.status_code == 200:
+                    received = 0
+                if response.headers.get('Accept-Ranges') == 'bytes':
+                    validator = response.headers.get('ETag') or response.headers.get('Last-Modified')
+                meta = {
+                    'etag': response.headers.get('ETag'),
+                    'last_modified': response.headers.get('Last-Modified'),
+                }
+                with open(tmp_path, 'ab' if received else 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        if _abort_downloads.is_set():
+                            raise DownloadAborted(url)
+                        f.write(chunk)
+                        received += len(chunk)
+
+            install_download(tmp_path, dest_path)
+            with open(tmp_path + '.meta', 'w') as meta_file:
+                json.dump(meta, meta_file)
+            os.replace(tmp_path + '.meta', meta_path)
+            return True
+
+        except DownloadAborted:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            print(f"Download of {url} aborted")
+            raise
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                requests.exceptions.ChunkedEncodingError, requests.exceptions.RetryError) as e:
+            if attempt == retries:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            wait = backoff * 2 ** attempt
+            print(f"Download of {url} failed ({e}), retrying in {wait}s")
+            time.sleep(wait)
+
+
+def download_to_workspace(url, dest_path):
+    # Download url into the cache under WORKSPACE_DIR, then copy it to dest_path in the
+    # run's workspace. The run only ever updates the workspace copy, so the cache keeps the
+    # file as published along with its ETag, and an unchanged file is not downloaded again
+    # by the next run. Returns True if the file was downloaded.
+    cache_dir = os.path.join(workspace_root, 'downloads')
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_path = os.path.join(cache_dir, os.path.basename(dest_path))
+    downloaded = download_file(url, cache_path)
+    copy_path = f'{dest_path}.{os.getpid()}.copy'
+    shutil.copyfile(cache_path, copy_path)
+    os.replace(copy_path, dest_path)
+    return downloaded
 
-            try:
-                reg_df.to_excel((str(rca_loc) + 'processed_rca.xlsx'), index=False, engine='xlsxwriter')
-                print(f'Processed RCA file loaded to {rca_loc}')
-            except Exception as ex:
-                print(f'An error occurred in building the processed excel file: {ex}')
 
-         
 # Define a function to download the database file and return the local file path
+@stage
 def download_database(url):
-    response = requests.get(url)
-    try:
-        if response.status_code == 200:
-            # Define a local file path to save the downloaded database
-            global local_db_path
-            local_db_path = config_dir['LOCAL_DB']
-            
-            # Save the content of the response to the local file
-            with open(local_db_path, 'wb') as f:
-                f.write(response.content)           
+    try:
+        # Save the download to the database path of the current run
+        if download_to_workspace(url, local_db_path):
             print('Database Downloaded')
-            return local_db_path
         else:
-            raise Exception(f"Failed to connect to the database, response code: error{response.status_code}")
+            print('Database unchanged, using the local copy')
+        return local_db_path
     except Exception as e:
         print(f"Failed to download the database, response code: error{e}")
 
 
+@stage
 def download_legacy_database(url):
     # download legacy data
-    response = requests.get(url)
-    try:
-        if response.status_code == 200:
-            # Define a local file path to save the downloaded database
-            global legacy_db_path
-            legacy_db_path = config_dir['LEGACY_DB']
-            
-            # Save the content of the response to the local file
-            with open(legacy_db_path, 'wb') as f:
-                f.write(response.content)
+    try:
+        # Save the download to the database path of the current run
+        if download_to_workspace(url, legacy_db_path):
             print('Legacy database Downloaded')
-            return legacy_db_path
         else:
-            raise Exception(f"Failed to download the database, response code: error{response.status_code}")
+            print('Legacy database unchanged, using the local copy')
+        return legacy_db_path
     except Exception as de:
         print(f"Failed to download the database, response code: error{de}")
 
 
-def create_current_dataframe():
+def create_current_dataframe(local_db_path=None):
 
-    local_db_path = download_database(raw_url)
+    # Download the database unless the fetch stage already has
+    if local_db_path is None:
+        local_db_path = download_database(raw_url)
 
     # Connect to your SQLite database
     c_conn = sqlite3.connect(local_db_path)
-    query1 = f"SELECT * FROM RCA_table"
-    current_df = pd.read_sql_query(query1, c_conn)
-    # Close the connection
-    c_conn.close()
+    try:
+        query1 = f"SELECT * FROM RCA_table"
+        current_df = pd.read_sql_query(query1, c_conn)
+    finally:
+        # Close the connection
+        c_conn.close()
     print('Current df created')
     return current_df
 
 
-def create_legacy_dataframe():
+def create_legacy_dataframe(legacy_db_path=None):
 
-    legacy_db_path = download_legacy_database(leg_url)
+    # Download the database unless the fetch stage already has
+    if legacy_db_path is None:
+        legacy_db_path = download_legacy_database(leg_url)
 
     # Connect to your SQLite database
     l_conn = sqlite3.connect(legacy_db_path)
-    query2 = f"SELECT * FROM RCA_table"
-    legacy_df = pd.read_sql_query(query2, l_conn)
-    # Close the connection
-    l_conn.close()
+    try:
+        query2 = f"SELECT * FROM RCA_table"
+        legacy_df = pd.read_sql_query(query2, l_conn)
+    finally:
+        # Close the connection
+        l_conn.close()
     print('legacy df created')
     return legacy_df
 
 
-def update_legacy():
-    leg_df = create_legacy_dataframe()
-    cur_df = create_current_dataframe()
+# Columns the change log can track; HISTORY_COLUMNS picks the ones it records
+RCA_CHANGE_COLUMNS = ['STATUS', 'CONNECTED', 'LAST_TRANSACTION_DATE']
+UPSERT_BATCH_SIZE = 50000
+
+
+def to_sql_values(df):
+    # Convert a dataframe to the plain python values sqlite3 stores: nulls become None,
+    # dates and timestamps become the same text to_sql writes
+    out = pd.DataFrame(index=df.index)
+    for col in df.columns:
+        series = df[col]
+        if pd.api.types.is_datetime64_any_dtype(series):
+            series = series.dt.strftime('%Y-%m-%d %H:%M:%S')
+        elif series.dtype == object:
+            series = series.map(lambda v: str(v) if isinstance(v, date) else v)
+        values = series.astype(object)
+        out[col] = values.where(values.notna(), None)
+    return out
+
+
+def ensure_keyed_table(conn, table, columns, key='Terminal_ID'):
+    # Make sure the table exists with a primary key on the terminal id and the given
+    # columns. Tables written by to_sql have no key, so they are rebuilt once, keeping
+    # the last row seen for each terminal.
+    info = conn.execute(f'PRAGMA table_info("{table}")').fetchall()
+    existing_cols = [row[1] for row in info]
+    has_key = any(row[1] == key and row[5] for row in info)
+    if has_key and set(existing_cols) == set(columns):
+        return
+
+    col_defs = ', '.join(f'"{col}" TEXT' for col in columns)
+    conn.execute(f'DROP TABLE IF EXISTS "{table}_keyed"')
+    conn.execute(f'CREATE TABLE "{table}_keyed" ({col_defs}, PRIMARY KEY ("{key}"))')
+    if existing_cols:
+        common = ', '.join(f'"{col}"' for col in columns if col in existing_cols)
+        conn.execute(
+            f'INSERT OR REPLACE INTO "{table}_keyed" ({common}) '
+            f'SELECT {common} FROM "{table}" WHERE "{key}" IS NOT NULL'
+        )
+        conn.execute(f'DROP TABLE "{table}"')
+    conn.execute(f'ALTER TABLE "{table}_keyed" RENAME TO "{table}"')
+
+
+def upsert_terminal_table(conn, df, table='RCA_table', key='Terminal_ID', delete_missing=False):
+    # Incrementally write df into a keyed table. Only rows that are new or differ in any
+    # non-key column are written, with batched INSERT ... ON CONFLICT DO UPDATE inside a
+    # single transaction. Returns the inserted/updated/unchanged/deleted counts.
+    df = df.dropna(subset=[key]).drop_duplicates(key, keep='last')
+    values = to_sql_values(df).reset_index(drop=True)
+    columns = list(values.columns)
+    value_columns = [col for col in columns if col != key]
+
+    with conn:
+        conn.execute('BEGIN')
+        ensure_keyed_table(conn, table, columns, key)
+
+        select_cols = ', '.join(f'"{col}"' for col in [key] + value_columns)
+        existing = pd.read_sql_query(f'SELECT {select_cols} FROM "{table}"', conn)
+        existing[key] = existing[key].astype(str)
+        values_key = values[key].astype(str)
+
+        merged = values[[key] + value_columns].assign(_key=values_key).merge(
+            existing.rename(columns={key: '_key'}), on='_key', how='left',
+            suffixes=('', '_old'), indicator=True
+        )
+        is_new = (merged['_merge'] == 'left_only').to_numpy()
+        is_changed = pd.Series(False, index=merged.index)
+        for col in value_columns:
+            new_val = merged[col].map(lambda v: None if pd.isna(v) else str(v))
+            old_val = merged[f'{col}_old']
+            is_changed |= (new_val != old_val) & ~(new_val.isna() & old_val.isna())
+        is_changed = is_changed.to_numpy() & ~is_new
+
+        to_write = values[is_new | is_changed]
+        col_list = ', '.join(f'"{col}"' for col in columns)
+        placeholders = ', '.join('?' for _ in columns)
+        if value_columns:
+            assignments = ', '.join(f'"{col}" = excluded."{col}"' for col in value_columns)
+            conflict = f'DO UPDATE SET {assignments}'
+        else:
+            conflict = 'DO NOTHING'
+        query = f'INSERT INTO "{table}" ({col_list}) VALUES ({placeholders}) ON CONFLICT("{key}") {conflict}'
+
+        rows = list(to_write.itertuples(index=False, name=None))
+        for start in range(0, len(rows), UPSERT_BATCH_SIZE):
+            conn.executemany(query, rows[start:start + UPSERT_BATCH_SIZE])
+
+        deleted = 0
+        if delete_missing:
+            stale = existing.loc[~in_terminal_index(existing[key], pd.Index(values_key)), key]
+            stale_rows = [(tid,) for tid in stale]
+            for start in range(0, len(stale_rows), UPSERT_BATCH_SIZE):
+                conn.executemany(f'DELETE FROM "{table}" WHERE "{key}" = ?', stale_rows[start:start + UPSERT_BATCH_SIZE])
+            deleted = len(stale_rows)
+
+    counts = {
+        'inserted': int(is_new.sum()),
+        'updated': int(is_changed.sum()),
+        'unchanged': int(len(values) - is_new.sum() - is_changed.sum()),
+        'deleted': deleted,
+    }
+    print(f"{table}: {counts['inserted']} inserted, {counts['updated']} updated, "
+          f"{counts['unchanged']} unchanged, {counts['deleted']} deleted")
+    return counts
+
+
+# Change log of RCA_table. Terminal IDs are stored once in RCA_terminals and referenced by
+# an integer id, statuses by their code in RCA_status. A row is appended to RCA_history
+# only when one of a terminal's tracked columns changes, so the state of a terminal at
+# any past time is its latest row at or before that time.
+HISTORY_STATUS_CODES = {'INACTIVE': 0, 'ACTIVE': 1, 'REMOVED': 2}
+HISTORY_REMOVED = HISTORY_STATUS_CODES['REMOVED']
+HISTORY_CODE_COLUMNS = {'STATUS': 'status', 'CONNECTED': 'connected', 'LAST_TRANSACTION_DATE': 'last_txn'}
+
+
+def ensure_history_tables(conn):
+    conn.execute('CREATE TABLE IF NOT EXISTS RCA_terminals (id INTEGER PRIMARY KEY, Terminal_ID TEXT NOT NULL UNIQUE)')
+    conn.execute('CREATE TABLE IF NOT EXISTS RCA_status (code INTEGER PRIMARY KEY, STATUS TEXT NOT NULL)')
+    conn.executemany('INSERT OR IGNORE INTO RCA_status (code, STATUS) VALUES (?, ?)',
+                     [(code, status) for status, code in HISTORY_STATUS_CODES.items()])
+    # The primary key is the (terminal, ts) index; WITHOUT ROWID stores the rows in it
+    # directly instead of in a separate rowid table. ts is the run time in unix seconds,
+    # connected is 0/1 and last_txn is the date as days since 1970-01-01.
+    conn.execute(
+        'CREATE TABLE IF NOT EXISTS RCA_history ('
+        'terminal INTEGER NOT NULL, ts INTEGER NOT NULL, status INTEGER NOT NULL, '
+        'connected INTEGER, last_txn INTEGER, PRIMARY KEY (terminal, ts)) WITHOUT ROWID'
+    )
+
+
+def terminal_codes(conn, terminal_ids):
+    # Integer id of each terminal, registering the terminals seen for the first time
+    known = pd.read_sql_query('SELECT id, Terminal_ID FROM RCA_terminals', conn)
+    known_index = pd.Index(known['Terminal_ID'].astype(str))
+    terminal_ids = pd.Index(terminal_ids.astype(str))
+    new_ids = terminal_ids[~in_terminal_index(terminal_ids, known_index)].unique()
+    if len(new_ids):
+        start = int(known['id'].max()) + 1 if len(known) else 1
+        new_codes = range(start, start + len(new_ids))
+        conn.executemany('INSERT INTO RCA_terminals (id, Terminal_ID) VALUES (?, ?)', zip(new_codes, new_ids))
+        known = pd.concat([known, pd.DataFrame({'id': new_codes, 'Terminal_ID': new_ids})], ignore_index=True)
+    lookup = pd.Series(known['id'].to_numpy(), index=known['Terminal_ID'].astype(str))
+    return lookup.reindex(terminal_ids).to_numpy()
+
+
+def encode_history_state(df):
+    # Integer codes of the tracked columns of an RCA frame, one row per terminal
+    dates = parse_dates(df['LAST_TRANSACTION_DATE']).dt.normalize()
+    return pd.DataFrame({
+        'status': df['STATUS'].astype(rca_dtypes()['STATUS']).cat.codes.to_numpy(),
+        'connected': df['CONNECTED'].astype(rca_dtypes()['CONNECTED']).cat.codes.to_numpy(),
+        'last_txn': ((dates - pd.Timestamp('1970-01-01')).dt.days).astype('Int64').to_numpy(),
+    })
+
+
+def history_as_of(conn, ts=None):
+    # Latest history row of every terminal at or before ts (all rows when ts is None).
+    # Each correlated MAX(ts) is a single seek on the (terminal, ts) primary key, so the
+    # query costs one seek per terminal however long the history grows. CROSS JOIN keeps
+    # SQLite from scanning the whole history table as the outer loop instead.
+    ts = sys.maxsize if ts is None else ts
+    return pd.read_sql_query(
+        'SELECT t.id AS terminal, t.Terminal_ID, h.ts, h.status, h.connected, h.last_txn '
+        'FROM RCA_terminals t CROSS JOIN RCA_history h ON h.terminal = t.id AND h.ts = '
+        '(SELECT MAX(ts) FROM RCA_history WHERE terminal = t.id AND ts <= ?)',
+        conn, params=(ts,)
+    )
+
+
+def compact_history(conn, before):
+    # Drop the history rows older than before, except the row each terminal stood at by
+    # then, so every state from before onwards is still answered exactly. Terminals that
+    # were already REMOVED by then lose that row too. Returns the number of rows dropped.
+    cursor = conn.execute(
+        'DELETE FROM RCA_history WHERE ts < ? AND (status = ? OR ts < '
+        '(SELECT MAX(ts) FROM RCA_history h WHERE h.terminal = RCA_history.terminal AND h.ts < ?))',
+        (before, HISTORY_REMOVED, before)
+    )
+    return cursor.rowcount
+
+
+def record_history(conn, df, ts=None, columns=None, retention_days=None):
+    # Append a row for every terminal of df whose tracked columns differ from its latest
+    # history row, and a REMOVED row for every terminal that dropped out of df, then
+    # compact the rows older than the retention window
+    ts = int(time.time()) if ts is None else ts
+    retention_days = history_retention_days if retention_days is None else retention_days
+    tracked = [HISTORY_CODE_COLUMNS[col] for col in (columns or history_columns)]
+    df = df.dropna(subset=['Terminal_ID']).drop_duplicates('Terminal_ID', keep='last')
+
+    with conn:
+        conn.execute('BEGIN')
+        ensure_history_tables(conn)
+        state = encode_history_state(df)
+        state.insert(0, 'terminal', terminal_codes(conn, df['Terminal_ID']))
+        latest = history_as_of(conn).drop(columns=['Terminal_ID', 'ts'])
+
+        merged = state.merge(latest, on='terminal', how='left', suffixes=('', '_old'), indicator=True)
+        changed = (merged['_merge'] == 'left_only') | (merged['status_old'] == HISTORY_REMOVED)
+        for col in tracked:
+            new_val = merged[col].astype('Int64')
+            old_val = merged[f'{col}_old'].astype('Int64')
+            changed |= (new_val.isna() != old_val.isna()) | (new_val != old_val).fillna(False)
+        rows = state[changed.to_numpy(dtype=bool)].assign(ts=ts)
+
+        gone = latest[(latest['status'] != HISTORY_REMOVED) & ~latest['terminal'].isin(state['terminal'])]
+        removed = pd.DataFrame({'terminal': gone['terminal'], 'ts': ts, 'status': HISTORY_REMOVED,
+                                'connected': None, 'last_txn': None})
+
+        query = 'INSERT OR REPLACE INTO RCA_history (terminal, ts, status, connected, last_txn) VALUES (?, ?, ?, ?, ?)'
+        for frame in (rows, removed):
+            values = to_sql_values(frame[['terminal', 'ts', 'status', 'connected', 'last_txn']])
+            records = list(values.itertuples(index=False, name=None))
+            for start in range(0, len(records), UPSERT_BATCH_SIZE):
+                conn.executemany(query, records[start:start + UPSERT_BATCH_SIZE])
+
+        compacted = compact_history(conn, ts - int(retention_days * 86400)) if retention_days else 0
+
+    print(f'RCA_history: {len(rows)} changed, {len(removed)} removed, {compacted} compacted')
+    return {'changed': len(rows), 'removed': len(removed), 'compacted': compacted}
+
+
+def state_as_of(when, db_path=None, columns=None):
+    # Terminals of RCA_table as they stood at `when` (a datetime, or a date meaning the
+    # end of that day), decoded from the change log, with the time of their last change.
+    # LAST_TRANSACTION_DATE is only included when the log tracks it; otherwise the stored
+    # date is the one of the terminal's last status change and misses later transactions.
+    if isinstance(when, date) and not isinstance(when, datetime):
+        when = datetime.combine(when, datetime.max.time())
+    conn = sqlite3.connect(db_path or local_db_path)
+    try:
+        state = history_as_of(conn, int(when.timestamp()))
+    finally:
+        conn.close()
+    state = state[state['status'] != HISTORY_REMOVED]
+    statuses = {code: status for status, code in HISTORY_STATUS_CODES.items()}
+    result = pd.DataFrame({
+        'Terminal_ID': state['Terminal_ID'],
+        'STATUS': state['status'].map(statuses).astype(rca_dtypes()['STATUS']),
+        'CONNECTED': pd.Categorical.from_codes(state['connected'].astype('int8'), dtype=rca_dtypes()['CONNECTED']),
+        'LAST_TRANSACTION_DATE': pd.Timestamp('1970-01-01') + pd.to_timedelta(state['last_txn'], unit='D'),
+        'CHANGED_AT': pd.to_datetime(state['ts'].map(datetime.fromtimestamp)),
+    }).reset_index(drop=True)
+    if 'LAST_TRANSACTION_DATE' not in (columns or history_columns):
+        result = result.drop(columns='LAST_TRANSACTION_DATE')
+    return result
+
+
+def terminal_history(terminal_id, db_path=None, columns=None):
+    # Every recorded change of one terminal, oldest first, with LAST_TRANSACTION_DATE
+    # only when the log tracks it, as in state_as_of
+    last_txn = ''
+    if 'LAST_TRANSACTION_DATE' in (columns or history_columns):
+        last_txn = ", date(h.last_txn * 86400, 'unixepoch') AS LAST_TRANSACTION_DATE"
+    conn = sqlite3.connect(db_path or local_db_path)
+    try:
+        return pd.read_sql_query(
+            "SELECT datetime(h.ts, 'unixepoch', 'localtime') AS CHANGED_AT, s.STATUS, "
+            f"CASE h.connected WHEN 1 THEN 'YES' WHEN 0 THEN 'NO' END AS CONNECTED{last_txn} "
+            'FROM RCA_history h JOIN RCA_terminals t ON t.id = h.terminal '
+            'JOIN RCA_status s ON s.code = h.status WHERE t.Terminal_ID = ? ORDER BY h.ts',
+            conn, params=(str(terminal_id),)
+        )
+    finally:
+        conn.close()
+
+
+def upsert_legacy_dates(leg_df, cur_df, today_date):
+    # Stamp every terminal in the current table with today's date in one batched pass.
+    # Membership is resolved through hashed indexes on Terminal_ID instead of scanning
+    # the legacy table once per terminal.
+    cur_ids = build_terminal_index(cur_df['Terminal_ID'])
+    leg_ids = build_terminal_index(leg_df['Terminal_ID'])
+
+    # Update the last transaction date for existing Terminal IDs
+    existing = in_terminal_index(leg_df['Terminal_ID'], cur_ids)
+    # Dates read back from SQLite are text; hold the column as objects so it takes date values
+    leg_df['LAST_TRANSACTION_DATE'] = leg_df['LAST_TRANSACTION_DATE'].astype(object)
+    leg_df.loc[existing, 'LAST_TRANSACTION_DATE'] = today_date
+
+    # Append the terminals the legacy table has not seen before, keeping their current order
+    new_ids = cur_ids[~in_terminal_index(cur_ids, leg_ids)]
+    if len(new_ids) == 0:
+        return leg_df
+    new_rows = pd.DataFrame({'Terminal_ID': new_ids, 'LAST_TRANSACTION_DATE': today_date})
+    return pd.concat([leg_df, new_rows], ignore_index=True)
+
+
+def upsert_legacy_dates_sql(conn, current_path, today_date, extra_terminal_ids=None, table='RCA_table'):
+    # The reconciliation of upsert_legacy_dates run inside SQLite: the current database
+    # is attached to the legacy one and every terminal is stamped with today's date by a
+    # single INSERT ... ON CONFLICT DO UPDATE, so neither table is loaded into memory.
+    # Returns the same counts as upsert_terminal_table.
+    today = today_date.isoformat()
+    conn.execute('ATTACH DATABASE ? AS cur', (current_path,))
+    try:
+        with conn:
+            conn.execute('BEGIN')
+            columns = [row[1] for row in conn.execute(f'PRAGMA main.table_info("{table}")').fetchall()]
+            ensure_keyed_table(conn, table, columns or ['Terminal_ID', 'LAST_TRANSACTION_DATE'])
+
+            conn.execute('CREATE TEMP TABLE legacy_terminals (Terminal_ID TEXT PRIMARY KEY) WITHOUT ROWID')
+            conn.execute(f'INSERT OR IGNORE INTO legacy_terminals SELECT Terminal_ID FROM cur."{table}" '
+                         'WHERE Terminal_ID IS NOT NULL')
+            if extra_terminal_ids is not None:
+                # Terminals of older RCA files folded into this run by batch mode
+                conn.executemany('INSERT OR IGNORE INTO legacy_terminals VALUES (?)',
+                                 ((str(tid),) for tid in pd.Series(extra_terminal_ids).dropna()))
+
+            existing = conn.execute(f'SELECT COUNT(*) FROM main."{table}"').fetchone()[0]
+            inserted = conn.execute(
+                f'SELECT COUNT(*) FROM legacy_terminals t WHERE NOT EXISTS '
+                f'(SELECT 1 FROM main."{table}" l WHERE l.Terminal_ID = t.Terminal_ID)'
+            ).fetchone()[0]
+            changes_before = conn.total_changes
+            # WHERE true keeps SQLite from parsing ON CONFLICT as a join constraint
+            conn.execute(
+                f'INSERT INTO main."{table}" (Terminal_ID, LAST_TRANSACTION_DATE) '
+                f'SELECT Terminal_ID, ? FROM legacy_terminals WHERE true '
+                f'ON CONFLICT(Terminal_ID) DO UPDATE SET LAST_TRANSACTION_DATE = excluded.LAST_TRANSACTION_DATE '
+                f'WHERE LAST_TRANSACTION_DATE IS NOT excluded.LAST_TRANSACTION_DATE',
+                (today,)
+            )
+            updated = conn.total_changes - changes_before - inserted
+            conn.execute('DROP TABLE temp.legacy_terminals')
+    finally:
+        conn.execute('DETACH DATABASE cur')
+
+    counts = {'inserted': inserted, 'updated': updated, 'unchanged': existing - updated, 'deleted': 0}
+    print(f"{table}: {counts['inserted']} inserted, {counts['updated']} updated, "
+          f"{counts['unchanged']} unchanged, {counts['deleted']} deleted")
+    return counts
+
+
+def update_legacy_sql(local_path=None, legacy_path=None, extra_terminal_ids=None):
+    # update_legacy with the SQL engine
+    if local_path is None:
+        local_path = download_database(raw_url)
+    if legacy_path is None:
+        legacy_path = download_legacy_database(leg_url)
+    print('Updating legacy date database')
+    conn = sqlite3.connect(legacy_path)
+    try:
+        counts = upsert_legacy_dates_sql(conn, local_path, date.today(), extra_terminal_ids)
+        print("Legacy database updated")
+    finally:
+        conn.close()
+    return counts
+
+
+@stage
+def update_legacy(local_path=None, legacy_path=None, extra_terminal_ids=None):
+    if legacy_engine == 'sql':
+        return update_legacy_sql(local_path, legacy_path, extra_terminal_ids)
+
+    # Download the database unless the fetch stage already has, then write back to the
+    # same file that was read
+    if legacy_path is None:
+        legacy_path = download_legacy_database(leg_url)
+    leg_df = create_legacy_dataframe(legacy_path)
+    cur_df = create_current_dataframe(local_path)
+    if extra_terminal_ids is not None:
+        # Terminals of older RCA files folded into this run by batch mode
+        extra_df = pd.DataFrame({'Terminal_ID': pd.Series(extra_terminal_ids, dtype=object)})
+        cur_df = pd.concat([cur_df[['Terminal_ID']], extra_df], ignore_index=True)
     print('Updating legacy date database')
 
-    today_date = date.today() 
+    today_date = date.today()
 
-    for tid in cur_df['Terminal_ID']:
-        if tid in leg_df['Terminal_ID'].values:
-            # Update the last transaction date for existing Terminal IDs
-            leg_df.loc[leg_df['Terminal_ID'] == tid, 'LAST_TRANSACTION_DATE'] = today_date
-        else:
-            # Create a new DataFrame with the new row
-            new_row = pd.DataFrame({'Terminal_ID': [tid], 'LAST_TRANSACTION_DATE': [today_date]})
-            # Concatenate the new DataFrame with the existing one
-            leg_df = pd.concat([leg_df, new_row], ignore_index=True)
-    
-    conn = sqlite3.connect(legacy_db_path)
-    # Replace the old database with the new file
+    leg_df = upsert_legacy_dates(leg_df, cur_df, today_date)
+
+    conn = sqlite3.connect(legacy_path)
+    # Write the updated dates to the legacy database
     try:
         print('Updating RCA TABLE')
-        leg_df.to_sql('RCA_table', conn, if_exists='replace', index=False)
+        counts = None
+        if db_write_mode == 'incremental':
+            counts = upsert_terminal_table(conn, leg_df)
+        else:
+            leg_df.to_sql('RCA_table', conn, if_exists='replace', index=False)
         print("Legacy database updated")
-    except Exception as e:
-        raise e 
-    conn.close()
+    finally:
+        conn.close()
+    return counts
 
 
-# Define a function to connect and update the database file in local
-def connect_and_update_database():
+def load_processed_rca():
+    # Load the processed RCA left in rca_loc by an earlier run, preferring the checkpoint
+    checkpoint_path = os.path.join(rca_loc, 'processed_rca.parquet')
+    excel_path = os.path.join(rca_loc, 'processed_rca.xlsx')
+    if os.path.exists(checkpoint_path):
+        return pd.read_parquet(checkpoint_path)
+    if os.path.exists(excel_path):
+        return pd.read_excel(excel_path)
+    print('No Available Processed RCA File')
 
-    if len(os.listdir(rca_loc)) == 0:
-        print('No Available Processed RCA File')
-    elif len(os.listdir(rca_loc)) > 1:
-        print(f'Cannot process multiple files in {rca_loc}')
-    else:
-        #loc_db_path = download_database(raw_url)
-        conn = sqlite3.connect(local_db_path)
 
-        for xfile in os.listdir(rca_loc):
-                excel_file_loc = str(rca_loc) + str(xfile)
+# Define a function to connect and update the database file in local
+@stage
+def connect_and_update_database(df=None):
 
-                df = pd.read_excel(excel_file_loc)
-                df = df.astype(str)
-                df['LAST_TRANSACTION_DATE'] = df['LAST_TRANSACTION_DATE'].apply(lambda x: x if pd.to_datetime(x, errors='coerce') is not pd.NaT else 'Not available')
-                df['LAST_TRANSACTION_DATE'] = pd.to_datetime(df['LAST_TRANSACTION_DATE'], errors='coerce')
-                df['LAST_TRANSACTION_DATE'] = df['LAST_TRANSACTION_DATE'].dt.date
+    # Use the frame handed over by transform_file, or reload it after a restart
+    if df is None:
+        df = load_processed_rca()
+        if df is None:
+            return
 
-        print('RCA file ready for db upload')
+    df = prepare_rca_for_db(df)
+    print('RCA file ready for db upload')
+    conn = sqlite3.connect(local_db_path)
 
+    if db_write_mode == 'incremental':
+        # Upsert only the terminals whose status, connection or date changed
+        try:
+            counts = upsert_terminal_table(conn, df, delete_missing=True)
+            if history_enabled:
+                counts['history'] = record_history(conn, df)
+            print("Database updated")
+            return counts
+        except Exception as e:
+            print(f"An error occurred updating the database: {e}")
+            raise
+        finally:
+            conn.close()
+
+    # Replace the old database with the new file
+    try:
         cursor = conn.cursor()
         query1 = """
-                CREATE TABLE RCA_table1 (
-                    Terminal_ID TEXT, 
-                    Merchant_Name TEXT, 
-                    Terminal_Owner TEXT,
-                    STATUS TEXT,
-                    CONNECTED TEXT, 
-                    LAST_TRANSACTION_DATE TEXT
-                );
-                """
+            CREATE TABLE RCA_table1 (
+                Terminal_ID TEXT, 
+                Merchant_Name TEXT, 
+                Terminal_Owner TEXT,
+                STATUS TEXT,
+                CONNECTED TEXT, 
+                LAST_TRANSACTION_DATE TEXT
+            );
+            """
         query2 = "DROP TABLE RCA_table;"
-        
+
         query3 = "ALTER TABLE RCA_table1 RENAME TO RCA_table;"
         cursor.execute(query1)
         cursor.execute(query2)
         cursor.execute(query3)
 
+        df.to_sql('RCA_table', conn, if_exists='replace', index=False)
+        if history_enabled:
+            record_history(conn, df)
+        print("Database updated")
+    except Exception as e:
+        print(f"An error occurred updating the database: {e}")
+        raise
+    finally:
+        conn.close()
 
-        # Replace the old database with the new file
-        try:
-            df.to_sql('RCA_table', conn, if_exists='replace', index=False)
-            print("Database updated")
-        except Exception as e:
-            print(f"An error occurred updating the database: {e}")
 
-        conn.close()
-        
-def load_to_github():
+# Read side of the published databases: indexes on the columns the dashboard filters on
+# and the grouping of the precomputed RCA_summary counts. STATUS and CONNECTED share one
+# index: it covers the filters on both flags, and a filter on CONNECTED alone still uses
+# it through a skip-scan, as STATUS has only two values.
+QUERY_INDEXES = [('Terminal_ID',), ('STATUS', 'CONNECTED'), ('LAST_TRANSACTION_DATE',)]
+SUMMARY_COLUMNS = ['Terminal_Owner', 'STATUS', 'CONNECTED']
 
-    # Connect to the githubAPI with the access tokens and usernames
-    username = config_git['USERNAME']
-    repository = config_git['REPOSITORY']
-    file_path = config_git['PATH']
-    access_token = config_git['TOKEN']
-    
-    # Enter the location of the new db file
-    new_db_filepath = local_db_path
-    
-    # Read the binary data from the new SQLite database file
-    with open(new_db_filepath, 'rb') as file:
-        new_content = file.read()
-
-    # Encode the binary content as Base64
-    content_base64 = base64.b64encode(new_content).decode('utf-8')
-
-    # Create the URL for the API endpoint
-    url = f'https://api.github.com/repos/{username}/{repository}/contents/{file_path}'
-
-    # Create the request headers with the authorization token
-    headers = {
-        'Authorization': f'token {access_token}'
-    }
 
-    def get_sha():
-        response = requests.get(sha_url, headers=headers)
+def table_indexes(conn, table):
+    # Columns of every index on the table, including the primary key's, in index order
+    indexes = []
+    for index in conn.execute(f'PRAGMA index_list("{table}")').fetchall():
+        info = conn.execute(f'PRAGMA index_info("{index[1]}")').fetchall()
+        indexes.append(tuple(row[2] for row in sorted(info)))
+    return indexes
 
-        if response.status_code == 200:
-            try:
-                # Try to parse JSON data
-                file_info = response.json()
-                sha = file_info.get("sha")
-                print('sha obtained')
-                return sha
-
-            except Exception as e:
-                    print(f"Error parsing JSON response: {e}")
-        else:
-            print(f"Failed to retrieve file info: {response.status_code} - {response.text}")
 
-        
-    sha = get_sha()
+def missing_query_indexes(conn, table, columns):
+    # QUERY_INDEXES the table has columns for but no index leading with them yet
+    existing = table_indexes(conn, table)
+    return [index for index in QUERY_INDEXES
+            if all(col in columns for col in index)
+            and not any(cols[:len(index)] == index for cols in existing)]
 
-    # Create the request payload with the new content as a base64-encoded string
-    data = {
-        'message': 'Update database file',
-        'content': content_base64,
-        'sha': sha
-    }
 
-    # Send a PUT request to update the file
-    response = requests.put(url, headers=headers, json=data)
+def database_finalized(db_path, table='RCA_table'):
+    # Whether finalize_database has nothing left to add: every query index and the
+    # summary table are in place and the page size is the configured one
+    conn = sqlite3.connect(db_path)
+    try:
+        columns = [row[1] for row in conn.execute(f'PRAGMA table_info("{table}")').fetchall()]
+        if not columns:
+            return True
+        has_summary = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'RCA_summary'").fetchone()
+        return (not missing_query_indexes(conn, table, columns)
+                and (has_summary is not None or not all(col in columns for col in SUMMARY_COLUMNS))
+                and conn.execute('PRAGMA page_size').fetchone()[0] == int(db_page_size))
+    finally:
+        conn.close()
 
-    if response.status_code == 200:
-        print('Database file updated successfully.')
-    else:
-        print('Failed to update database file:', response.text, response.status_code)
 
+def database_written(counts):
+    # Whether an update wrote anything, from the counts it returned. An update without
+    # counts, such as a replace mode write, always counts as written.
+    if counts is None:
+        return True
+    history = counts.get('history') or {}
+    return any(counts.get(key) for key in ('inserted', 'updated', 'deleted')) or any(history.values())
 
-def load_legacy_to_github():
 
-    # Connect to the githubAPI with the access tokens and usernames
-    username = config_git['USERNAME']
-    repository = config_git['REPOSITORY']
-    file_path = config_git['LEG_PATH']
-    access_token = config_git['TOKEN']
-    
-    # Enter the location of the new db file
-    new_db_filepath = legacy_db_path
-    
-    # Read the binary data from the new SQLite database file
-    with open(new_db_filepath, 'rb') as file:
-        new_content = file.read()
-
-    # Encode the binary content as Base64
-    content_base64 = base64.b64encode(new_content).decode('utf-8')
-
-    # Create the URL for the API endpoint
-    url = f'https://api.github.com/repos/{username}/{repository}/contents/{file_path}'
-
-    # Create the request headers with the authorization token
-    headers = {
-        'Authorization': f'token {access_token}'
-    }
+@stage
+def finalize_database(db_path=None, table='RCA_table'):
+    # Prepare a database for publishing: index the columns the dashboard queries,
+    # rebuild the summary counts, refresh the planner statistics, then VACUUM, which
+    # drops free pages and applies the page size
+    db_path = db_path or local_db_path
+    conn = sqlite3.connect(db_path)
+    try:
+        columns = [row[1] for row in conn.execute(f'PRAGMA table_info("{table}")').fetchall()]
+        if not columns:
+            print(f'No {table} in {db_path} to finalize')
+            return
+        with conn:
+            for index in missing_query_indexes(conn, table, columns):
+                name = '_'.join((table,) + index + ('idx',))
+                index_cols = ', '.join(f'"{col}"' for col in index)
+                conn.execute(f'CREATE INDEX "{name}" ON "{table}" ({index_cols})')
+
+            conn.execute('DROP TABLE IF EXISTS RCA_summary')
+            if all(col in columns for col in SUMMARY_COLUMNS):
+                group = ', '.join(f'"{col}"' for col in SUMMARY_COLUMNS)
+                conn.execute(f'CREATE TABLE RCA_summary AS SELECT {group}, COUNT(*) AS TERMINALS '
+                             f'FROM "{table}" GROUP BY {group} ORDER BY {group}')
+        conn.execute('ANALYZE')
+        conn.execute(f'PRAGMA page_size = {int(db_page_size)}')
+        conn.execute('VACUUM')
+        print(f'{os.path.basename(db_path)} finalized')
+    finally:
+        conn.close()
 
-    def get_sha():
-        response = requests.get(leg_sha, headers=headers)
 
-        if response.status_code == 200:
-            try:
-                # Try to parse JSON data
-                file_info = response.json()
-                sha = file_info.get("sha")
-                print('sha obtained')
-                return sha
-
-            except Exception as e:
-                    print(f"Error parsing JSON response: {e}")
+def git_blob_sha(file_path, chunk_size=1024 * 1024):
+    # Git blob id of a local file, the same sha GitHub reports for the published file,
+    # so an unchanged database can be detected without downloading it
+    digest = hashlib.sha1(f'blob {os.path.getsize(file_path)}\0'.encode())
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def stream_blob_payload(file_path, chunk_size=3 * 1024 * 1024):
+    # Yield the JSON body of a git blob request with the file base64 encoded chunk by
+    # chunk. The chunk size is a multiple of 3 so the encoded chunks join without padding.
+    yield b'{"encoding": "base64", "content": "'
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            yield base64.b64encode(chunk)
+    yield b'"}'
+
+
+# Compressed artifacts. gzip uses the standard library; zstd uses pyarrow's codec, so it
+# needs pyarrow, as the Parquet export does. Both are written deterministically, so an
+# unchanged database gives an unchanged artifact and publish_to_github skips it.
+ARTIFACT_SUFFIXES = {'gzip': '.gz', 'zstd': '.zst'}
+COMPRESSION_MAGIC = {'gzip': b'\x1f\x8b', 'zstd': b'\x28\xb5\x2f\xfd'}
+COMPRESSION_LEVELS = {'gzip': 6, 'zstd': 9}
+# zstd artifacts are a sequence of independent frames of this much input, which any
+# zstd decoder reads as one stream
+ZSTD_FRAME_SIZE = 16 * 1024 * 1024
+
+
+def detect_compression(path):
+    # 'gzip' or 'zstd' from the file's magic bytes, None for anything else
+    with open(path, 'rb') as file:
+        head = file.read(4)
+    for compression, magic in COMPRESSION_MAGIC.items():
+        if head.startswith(magic):
+            return compression
+    return None
+
+
+@contextlib.contextmanager
+def open_decompressed(path, compression):
+    # Streaming reader of a gzip or zstd file
+    if compression == 'gzip':
+        with gzip.open(path, 'rb') as file:
+            yield file
+    elif compression == 'zstd':
+        import pyarrow as pa
+        with pa.OSFile(path, 'rb') as raw, pa.CompressedInputStream(raw, 'zstd') as file:
+            yield file
+    else:
+        raise ValueError(f'Unsupported compression: {compression}')
+
+
+def compress_file(src_path, dest_path, compression, level=None):
+    level = level or COMPRESSION_LEVELS[compression]
+    with open(src_path, 'rb') as src, open(dest_path, 'wb') as dest:
+        if compression == 'gzip':
+            # No file name or timestamp in the header, so the output depends only on the input
+            with gzip.GzipFile(filename='', mode='wb', fileobj=dest, compresslevel=level, mtime=0) as file:
+                shutil.copyfileobj(src, file, DOWNLOAD_CHUNK_SIZE)
+        elif compression == 'zstd':
+            import pyarrow as pa
+            codec = pa.Codec('zstd', compression_level=level)
+            for chunk in iter(lambda: src.read(ZSTD_FRAME_SIZE), b''):
+                dest.write(codec.compress(chunk, asbytes=True))
         else:
-            print(f"Failed to retrieve file info: {response.status_code} - {response.text}")
+            raise ValueError(f'Unsupported compression: {compression}')
 
-        
-    sha = get_sha()
 
-    # Create the request payload with the new content as a base64-encoded string
-    data = {
-        'message': 'Update database file',
-        'content': content_base64,
-        'sha': sha
-    }
+def install_download(tmp_path, dest_path):
+    # Move a finished download into place, decompressing a gzip or zstd artifact chunk by
+    # chunk on the way, so the compressed artifacts can be downloaded like the databases
+    compression = detect_compression(tmp_path)
+    if compression is None:
+        os.replace(tmp_path, dest_path)
+        return
+    inflating_path = dest_path + '.inflating'
+    with open_decompressed(tmp_path, compression) as src, open(inflating_path, 'wb') as dest:
+        shutil.copyfileobj(src, dest, DOWNLOAD_CHUNK_SIZE)
+    os.replace(inflating_path, dest_path)
+    os.remove(tmp_path)
 
-    # Send a PUT request to update the file
-    response = requests.put(url, headers=headers, json=data)
 
+SQLITE_ARROW_TYPES = {'INTEGER': 'int64', 'REAL': 'float64'}
+
+
+def export_parquet(db_path, dest_path, table='RCA_table', chunk_size=RCA_CHUNK_SIZE):
+    # Write a table to a zstd compressed Parquet file, chunk by chunk. The schema comes
+    # from the declared column types, so a chunk of all-null values keeps its type.
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    conn = sqlite3.connect(db_path)
+    try:
+        info = conn.execute(f'PRAGMA table_info("{table}")').fetchall()
+        schema = pa.schema([(row[1], SQLITE_ARROW_TYPES.get(row[2].upper(), 'string')) for row in info])
+        with pq.ParquetWriter(dest_path, schema, compression='zstd') as writer:
+            for chunk in pd.read_sql_query(f'SELECT * FROM "{table}"', conn, chunksize=chunk_size):
+                writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+    finally:
+        conn.close()
+
+
+def artifact_entry(local_path, **details):
+    return dict(details, sha256=file_digest(local_path), size=os.path.getsize(local_path))
+
+
+def database_artifacts(local_path, repo_path, file_sha_url):
+    # Files to publish for one database as (local_path, repo_path, sha_url) entries: the
+    # database itself, its compressed copy and Parquet export when enabled, and a
+    # manifest with the hash and size of each. Artifacts are written next to the database.
+    files = []
+    if publish_raw or not (artifact_compression or publish_parquet):
+        files.append((local_path, repo_path, file_sha_url))
+    if not (artifact_compression or publish_parquet):
+        return files
+
+    stem, repo_stem = os.path.splitext(local_path)[0], os.path.splitext(repo_path)[0]
+    manifest = {'database': artifact_entry(local_path, path=repo_path, format='sqlite'), 'artifacts': []}
+    if files:
+        manifest['artifacts'].append(manifest['database'])
+    if artifact_compression:
+        suffix = ARTIFACT_SUFFIXES[artifact_compression]
+        compress_file(local_path, local_path + suffix, artifact_compression, compression_level)
+        files.append((local_path + suffix, repo_path + suffix, None))
+        manifest['artifacts'].append(artifact_entry(local_path + suffix, path=repo_path + suffix, format='sqlite',
+                                                    compression=artifact_compression))
+    if publish_parquet:
+        export_parquet(local_path, stem + '.parquet')
+        files.append((stem + '.parquet', repo_stem + '.parquet', None))
+        manifest['artifacts'].append(artifact_entry(stem + '.parquet', path=repo_stem + '.parquet',
+                                                    format='parquet', table='RCA_table'))
+
+    with open(stem + '.manifest.json', 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+    files.append((stem + '.manifest.json', repo_stem + '.manifest.json', None))
+    return files
+
+
+def get_published_sha(session, file_sha_url):
+    # Sha of the file currently published on GitHub, from its contents API url
+    response = session.get(file_sha_url)
     if response.status_code == 200:
-        print('Legacy dates database file updated successfully.')
+        try:
+            sha = response.json().get("sha")
+            print('sha obtained')
+            return sha
+        except Exception as e:
+            print(f"Error parsing JSON response: {e}")
     else:
-        print('Failed to update database file:', response.text, response.status_code)
+        print(f"Failed to retrieve file info: {response.status_code} - {response.text}")
 
 
-def move_raw_rca_to_archive():
-    ctx_auth = UserCredential(sharepoint_username, sharepoint_password)
-    ctx = ClientContext(sharepoint_site_url).with_credentials(ctx_auth)
+_github_session = None
 
-    # Load the file to archive
-    try:
-        if len(os.listdir(inputrca_loc)) > 0:
-            for file in os.listdir(inputrca_loc):
-                # Connect to SharePoint and upload files
-                local_file_path = inputrca_loc + file
-                
-                sharepoint_library_name = '/sites/NIBSS-ITEXrepo/Shared Documents/RCA_archives'
 
-                # Construct the file path in SharePoint
-                target_folder = ctx.web.get_folder_by_server_relative_url(sharepoint_library_name)
-                target_file = target_folder.upload_file(os.path.basename(local_file_path), open(local_file_path, 'rb'))
-                ctx.execute_query()
+def get_github_session():
+    # One authenticated session per process, so a long running service reuses its connection
+    global _github_session
+    if _github_session is None:
+        import requests
+        _github_session = requests.Session()
+        _github_session.headers.update({
+            'Authorization': f"token {config_git['TOKEN']}",
+            'Accept': 'application/vnd.github+json',
+        })
+    return _github_session
 
-                print(f"{file} uploaded successfully to RCA_archives.")
 
-        else:
-            print("Missing local raw RCA file")
-            return
-        
-    except Exception as e:
-        print(f"An error occured:{e}")
+@stage
+def publish_to_github(files, message='Update database file'):
+    # Publish the given (local_path, repo_path, sha_url) files in a single commit through
+    # the Git Data API. Files whose blob sha matches the published one are skipped, and
+    # nothing is committed when no file changed.
+    username = config_git['USERNAME']
+    repository = config_git['REPOSITORY']
+    repo_url = f'{github_api_url}/repos/{username}/{repository}'
 
-    folder_list_url = '/sites/NIBSS-ITEXrepo/Shared Documents/RCA_input'
+    session = get_github_session()
 
-    # Clean the file 
     try:
-        # Get the folder by its relative URL
-        list_source = ctx.web.get_folder_by_server_relative_url(folder_list_url)
-        files = list_source.files
-        ctx.load(files)
-        ctx.execute_query()
+        changed = []
+        for local_path, repo_path, file_sha_url in files:
+            local_sha = git_blob_sha(local_path)
+            file_sha_url = file_sha_url or f'{repo_url}/contents/{urllib.parse.quote(repo_path)}'
+            if local_sha == get_published_sha(session, file_sha_url):
+                print(f'{repo_path} is unchanged, skipping upload')
+            else:
+                changed.append((local_path, repo_path, local_sha))
+
+        if not changed:
+            print('No database changes to publish.')
+            return None
+
+        branch = config_git.get('BRANCH')
+        if not branch:
+            response = session.get(repo_url)
+            response.raise_for_status()
+            branch = response.json()['default_branch']
+
+        response = session.get(f'{repo_url}/git/ref/heads/{branch}')
+        response.raise_for_status()
+        head_sha = response.json()['object']['sha']
+
+        response = session.get(f'{repo_url}/git/commits/{head_sha}')
+        response.raise_for_status()
+        base_tree = response.json()['tree']['sha']
+
+        # Upload each changed file as a blob, streaming the base64 body
+        tree = []
+        for local_path, repo_path, local_sha in changed:
+            response = session.post(f'{repo_url}/git/blobs', data=stream_blob_payload(local_path),
+                                    headers={'Content-Type': 'application/json'})
+            response.raise_for_status()
+            blob_sha = response.json()['sha']
+            if blob_sha != local_sha:
+                raise Exception(f'Uploaded blob sha {blob_sha} does not match {repo_path} ({local_sha})')
+            tree.append({'path': repo_path, 'mode': '100644', 'type': 'blob', 'sha': blob_sha})
+            print(f'{repo_path} uploaded')
+
+        response = session.post(f'{repo_url}/git/trees', json={'base_tree': base_tree, 'tree': tree})
+        response.raise_for_status()
+        tree_sha = response.json()['sha']
+
+        response = session.post(f'{repo_url}/git/commits',
+                                json={'message': message, 'tree': tree_sha, 'parents': [head_sha]})
+        response.raise_for_status()
+        commit_sha = response.json()['sha']
+
+        response = session.patch(f'{repo_url}/git/refs/heads/{branch}', json={'sha': commit_sha})
+        response.raise_for_status()
+        print('Database files updated successfully.')
+        return commit_sha
 
-        # Check if the folder is empty
+    except Exception as e:
+        print(f'Failed to update database files: {e}')
+        raise
+
+
+def load_to_github():
+    # Publish the current RCA database on its own
+    return publish_to_github(database_artifacts(local_db_path, config_git['PATH'], sha_url))
+
+
+def load_legacy_to_github():
+    # Publish the legacy dates database on its own
+    return publish_to_github(database_artifacts(legacy_db_path, config_git['LEG_PATH'], leg_sha))
+
+
+def load_databases_to_github():
+    # Publish both databases in a single commit
+    return publish_to_github(
+        database_artifacts(local_db_path, config_git['PATH'], sha_url)
+        + database_artifacts(legacy_db_path, config_git['LEG_PATH'], leg_sha)
+    )
+
+
+@stage
+def move_raw_rca_to_archive():
+    if not os.path.exists(inputrca_loc) or len(os.listdir(inputrca_loc)) == 0:
+        print("Missing local raw RCA file")
+        return
+
+    # Move the raw files this run processed from RCA_input to RCA_archives on the server;
+    # files that arrived in RCA_input during the run stay there for the next run
+    try:
+        processed = set(os.listdir(inputrca_loc))
+        files = [file for file in list_sharepoint_files(sharepoint_input_folder)
+                 if file.properties['Name'] in processed]
         if len(files) == 0:
             print("The 'RCA_input' folder is empty. No files to move.")
             return
-        else:
-            files_to_delete = []
 
-            # Iterate through files and add them to the delete list
-            for file in files:
-                files_to_delete.append(file)
+        move_sharepoint_files(files, sharepoint_archive_folder)
+        for file in files:
+            print(f"{file.properties['Name']} moved successfully to RCA_archives.")
 
-            # Delete the files outside the loop
-            for file in files_to_delete:
-                file.delete_object()
+    except Exception as e:
+        print(f"An error occurred archiving raw RCA files: {e}")
+        raise
 
-            # Execute the query after all delete operations
-            ctx.execute_query()
-            print('Raw RCA deleted successfully.')
 
-    except Exception as e:
-        print(f"An error occurred deleting raw file: {e}")
+def workspace_path(run_id):
+    return os.path.join(workspace_root, f'run_{run_id}')
 
 
-def clean_data():
+@stage
+def remove_workspace(path):
+    # Rename the workspace out of the way in one step, then delete it. A crash part way
+    # leaves only a '.removing' directory, which the next run clears.
+    if not os.path.exists(path):
+        return
+    removing = path + '.removing'
+    os.replace(path, removing)
+    shutil.rmtree(removing)
+    print(f"Workspace '{path}' deleted successfully.")
 
-    time.sleep(10)
 
-    # Delete the downloaded db file
-    try:
-        # Attempt to terminate any processes holding a handle to the file
-        for proc in psutil.process_iter(['pid', 'name', 'open_files']):
-            open_files = proc.info.get('open_files')
-            if open_files:
-                for item in open_files:
-                    if local_db_path == item.path:
-                        print(f"Terminating process {proc.info['pid']} ({proc.info['name']}) holding the file '{local_db_path}'.")
-                        psutil.Process(proc.info['pid']).terminate()
-                        time.sleep(1)  # Allow some time for the process to terminate
+WORKSPACE_OWNER = 'owner.json'
 
-        os.remove(local_db_path)
-        print(f"File '{local_db_path}' deleted successfully.")
-    except FileNotFoundError:
-        print(f"File '{local_db_path}' not found.")
-    except PermissionError as pe:
-        print(f"Permission denied. Unable to delete file local_db file: {pe}")
-    except Exception as e:
-        print(f"An error occurred while deleting the file: {e}")
 
+def claim_workspace(path):
+    # Record the process running in a workspace, so other runs leave it alone
+    import socket
+    with open(os.path.join(path, WORKSPACE_OWNER), 'w') as owner_file:
+        json.dump({'host': socket.gethostname(), 'pid': os.getpid()}, owner_file)
+
+
+def workspace_abandoned(path):
+    # A workspace is abandoned when the process that claimed it on this host has exited.
+    # A workspace claimed on another host, or never claimed, is only abandoned once it
+    # has not been modified for stale_workspace_hours.
+    import psutil
+    import socket
+    owner_path = os.path.join(path, WORKSPACE_OWNER)
     try:
-        os.remove(legacy_db_path)
-        print(f"File '{legacy_db_path}' deleted successfully.")
-    except FileNotFoundError:
-        print(f"File '{legacy_db_path}' not found.")
-    except PermissionError as pe:
-        print(f"Permission denied. Unable to delete file local_db file: {pe}")
-    except Exception as e:
-        print(f"An error occurred while deleting the file: {e}")
+        with open(owner_path) as owner_file:
+            owner = json.load(owner_file)
+        if owner.get('host') == socket.gethostname():
+            return not psutil.pid_exists(owner['pid'])
+        modified = os.path.getmtime(owner_path)
+    except (OSError, ValueError, KeyError):
+        modified = os.path.getmtime(path)
+    return time.time() - modified > stale_workspace_hours * 3600
+
+
+def remove_stale_workspaces(keep):
+    # Clear what remove_workspace left half deleted, and workspaces abandoned by runs that
+    # are no longer resumable. Workspaces of runs still going in other processes are kept.
+    if not os.path.exists(workspace_root):
+        return
+    for name in os.listdir(workspace_root):
+        path = os.path.join(workspace_root, name)
+        if not name.startswith('run_') or path == keep:
+            continue
+        try:
+            if name.endswith('.removing') or workspace_abandoned(path):
+                shutil.rmtree(path, ignore_errors=True)
+        except OSError:
+            # Removed by its own run while this one was looking
+            continue
+
+
+@contextlib.contextmanager
+def run_workspace(run_id):
+    # Point the database paths and the raw and processed RCA folders into a per-run
+    # directory for the duration of the run. The workspace is removed as soon as the run
+    # completes; a failed run keeps it so the next invocation can resume from its files.
+    # Every database connection is closed by the stage that opened it, so nothing holds a
+    # file open by the time the workspace is removed.
+    global local_db_path, legacy_db_path, inputrca_loc, rca_loc
+    path = workspace_path(run_id)
+    remove_stale_workspaces(keep=path)
+    previous = local_db_path, legacy_db_path, inputrca_loc, rca_loc
+    local_db_path = os.path.join(path, os.path.basename(config_dir['LOCAL_DB']))
+    legacy_db_path = os.path.join(path, os.path.basename(config_dir['LEGACY_DB']))
+    inputrca_loc = os.path.join(path, 'raw_rca') + os.sep
+    rca_loc = os.path.join(path, 'processed_rca') + os.sep
+    os.makedirs(inputrca_loc, exist_ok=True)
+    os.makedirs(rca_loc, exist_ok=True)
+    claim_workspace(path)
+    try:
+        yield path
+        wait_for_exports()
+        remove_workspace(path)
+    finally:
+        local_db_path, legacy_db_path, inputrca_loc, rca_loc = previous
+
+
+def default_fetch_sources():
+    # The independent network fetches of a run, keyed by their name in the run context.
+    # The VAS aggregation needs the registered terminals, so it follows the SharePoint
+    # download inside the 'rca' fetch while the databases download alongside it. The
+    # 'rca' fetch waits for the current database before the aggregation, to check the
+    # row count drift against it.
+    local_db_ready = threading.Event()
+
+    def fetch_local_db():
+        try:
+            return download_database(raw_url)
+        finally:
+            local_db_ready.set()
+
+    return {
+        'rca': lambda: load_rca_inputs(local_db_ready),
+        'local_db': fetch_local_db,
+        'legacy_db': lambda: download_legacy_database(leg_url),
+    }
+
+
+@stage
+def fetch_sources(sources=None):
+    # Run the fetches concurrently on a thread pool and collect their results into a
+    # run context, with the time each source took under 'timings'
+    if sources is None:
+        sources = default_fetch_sources()
 
-    # Delete the raw rca file
-    for i in os.listdir(inputrca_loc):
-        del_file = str(inputrca_loc) + str(i)
+    def timed_fetch(name, fetch):
+        start = time.perf_counter()
         try:
-            os.remove(del_file)
-            print(f"Raw RCA file deleted successfully.")
-        except FileNotFoundError:
-            print(f"File '{del_file}' not found.")
-        except PermissionError:
-            print(f"Permission denied. Unable to delete file '{del_file}'.")
+            return fetch(), time.perf_counter() - start
+        except RCAValidationError:
+            raise
         except Exception as e:
-            print(f"An error occurred while deleting the file: {e}")
+            print(f"An error occurred fetching {name}: {e}")
+            run_context['errors'][name] = e
+            return None, time.perf_counter() - start
+
+    run_context = {'timings': {}, 'errors': {}}
+    start = time.perf_counter()
+    _abort_downloads.clear()
+    executor = ThreadPoolExecutor(max_workers=len(sources))
+    try:
+        futures = {executor.submit(timed_fetch, name, fetch): name for name, fetch in sources.items()}
+        for future in as_completed(futures):
+            run_context[futures[future]], run_context['timings'][futures[future]] = future.result()
+    except RCAValidationError:
+        # A rejected RCA file ends the run, so stop the database downloads rather than
+        # wait for them to finish
+        _abort_downloads.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    executor.shutdown()
+    wall_time = time.perf_counter() - start
+
+    for name, elapsed in run_context['timings'].items():
+        print(f"Fetched {name} in {elapsed:.2f}s")
+    print(f"Fetch stage took {wall_time:.2f}s wall clock "
+          f"({sum(run_context['timings'].values()):.2f}s if run one after another)")
+    run_context['timings']['fetch_stage'] = wall_time
+    return run_context
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    # sha256 of a file, or None when it does not exist
+    if not path or not os.path.exists(path):
+        return None
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def frame_digest(df):
+    # sha256 of a dataframe's contents
+    if df is None:
+        return None
+    return hashlib.sha256(pd.util.hash_pandas_object(df, index=False).values.tobytes()).hexdigest()
+
+
+def load_run_state():
+    if os.path.exists(run_state_path):
+        with open(run_state_path) as f:
+            return json.load(f)
+    return {'status': 'completed', 'stages': {}}
+
+
+def save_run_state(state):
+    # Write through a temp file so a crash never leaves a half written checkpoint
+    with open(run_state_path + '.tmp', 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(run_state_path + '.tmp', run_state_path)
+
+
+def run_stage(state, name, func, inputs, outputs=lambda: {}):
+    # Run one stage unless it already succeeded with the same inputs and its recorded
+    # outputs are still in place. inputs is a dict of values or content hashes; outputs
+    # computes the content hashes of what the stage leaves on disk.
+    inputs_hash = hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode()).hexdigest()
+    previous = state['stages'].get(name)
+    if (previous and previous['status'] == 'ok' and previous['inputs'] == inputs_hash
+            and previous['outputs'] == outputs()):
+        print(f'Skipping {name}: inputs and outputs unchanged')
+        return previous.get('values', {}), True
+
+    state['stages'][name] = {'inputs': inputs_hash, 'status': 'running', 'outputs': {}}
+    save_run_state(state)
+    try:
+        values = func()
+    except Exception:
+        state['stages'][name]['status'] = 'failed'
+        save_run_state(state)
+        raise
+    if not isinstance(values, dict):
+        values = {}
+    state['stages'][name] = {
+        'inputs': inputs_hash,
+        'status': 'ok',
+        'outputs': outputs(),
+        'values': values,
+        'finished_at': datetime.now().isoformat(timespec='seconds'),
+    }
+    save_run_state(state)
+    return values, False
+
 
-    # Finally delete the processed RCA file
-    for i in os.listdir(rca_loc):
-        del_file = str(rca_loc) + str(i)
+def main():
+    load_config()
+    started_at = datetime.now()
+    with _metrics_lock:
+        run_metrics.clear()
+    try:
+        run_pipeline()
+    finally:
+        write_run_report(started_at)
+
+
+def run_pipeline():
+    # Run the stages through the checkpointed runner. A run that failed is resumed at the
+    # failed stage, skipping the stages it already completed with unchanged inputs.
+    state = load_run_state()
+    if state['status'] == 'completed':
+        # A new run starts from no stage records, so nothing of an earlier run is skipped;
+        # the microseconds keep run ids (and workspaces) of back to back runs apart
+        state['run_id'] = datetime.now().strftime('%Y%m%d%H%M%S%f')
+        state['stages'] = {}
+    else:
+        print(f"Resuming run {state['run_id']}")
+    state['status'] = 'running'
+    save_run_state(state)
+
+    try:
+        with run_workspace(state['run_id']):
+            run_stages(state)
+        state['status'] = 'completed'
+    except Exception:
+        state['status'] = 'failed'
+        raise
+    finally:
+        save_run_state(state)
+
+
+def run_stages(state):
+    local_path = local_db_path
+    legacy_path = legacy_db_path
+    checkpoint_path = os.path.join(rca_loc, 'processed_rca.parquet')
+    run_context = {}
+    processed = {}
+
+    batch_ids_path = os.path.join(rca_loc, 'batch_terminals.parquet')
+
+    def fetch():
+        run_context.update(fetch_sources())
+        if 'rca' in run_context['errors']:
+            raise run_context['errors']['rca']
+        if run_context['local_db'] is None or run_context['legacy_db'] is None:
+            raise Exception('Database download failed')
+        if run_context['rca'] is None:
+            return {}
+        return {'latest_dates': frame_digest(run_context['rca']['latest_dates'])}
+
+    def transform():
+        if len(raw_files) > 1:
+            # Batch mode: fold the backlog of raw RCA files into this run
+            processed['df'], older_ids = transform_batch(raw_files)
+            os.makedirs(rca_loc, exist_ok=True)
+            pd.DataFrame({'Terminal_ID': pd.Series(older_ids, dtype=object)}).to_parquet(batch_ids_path, index=False)
+        else:
+            processed['df'] = transform_file(run_context.get('rca'))
+        if processed['df'] is None:
+            raise Exception('No processed RCA data')
+        if not checkpoint_processed_rca or len(raw_files) > 1:
+            write_checkpoint(processed['df'])
+
+    fetched, _ = run_stage(
+        state, 'fetch', fetch, {'run_id': state['run_id']},
+        lambda: {'raw_rca': [file_digest(path) for path in pending_rca_files()],
+                 'local_db': os.path.exists(local_path), 'legacy_db': os.path.exists(legacy_path)})
+    raw_files = pending_rca_files()
+    if not raw_files:
+        print('No Available Raw RCA File')
+        return
+    raw_digests = [file_digest(path) for path in raw_files]
+
+    _, skipped = run_stage(
+        state, 'transform_file', transform,
+        {'raw_rca': raw_digests, 'latest_dates': fetched.get('latest_dates')},
+        lambda: {'processed': file_digest(checkpoint_path)})
+    if skipped:
+        processed['df'] = load_processed_rca()
+
+    older_ids = None
+    if len(raw_files) > 1:
+        older_ids = pd.read_parquet(batch_ids_path)['Terminal_ID']
+
+    def finalized(update, path):
+        # Finalize inside the update's stage, so the digest it records is the one published.
+        # An update that wrote nothing to an already finalized database leaves its bytes
+        # as downloaded, so the publisher sees the file unchanged and skips it.
+        def run():
+            counts = update()
+            if finalize_db:
+                if database_written(counts) or not database_finalized(path):
+                    finalize_database(path)
+                else:
+                    print(f'{os.path.basename(path)} unchanged and already finalized')
+            return counts
+        return run
+
+    run_stage(
+        state, 'update_legacy', finalized(lambda: update_legacy(local_path, legacy_path, older_ids), legacy_path),
+        {'run_id': state['run_id']},
+        lambda: {'legacy_db': file_digest(legacy_path)})
+
+    run_stage(
+        state, 'connect_and_update_database', finalized(lambda: connect_and_update_database(processed['df']), local_path),
+        {'processed': file_digest(checkpoint_path)},
+        lambda: {'local_db': file_digest(local_path)})
+
+    run_stage(
+        state, 'load_databases_to_github', load_databases_to_github,
+        {'local_db': file_digest(local_path), 'legacy_db': file_digest(legacy_path)})
+
+    # Keyed on the run, so the files of a new run are archived even when their bytes match
+    # the files of an earlier one
+    run_stage(
+        state, 'move_raw_rca_to_archive', move_raw_rca_to_archive,
+        {'run_id': state['run_id']})
+
+
+# Service mode: poll RCA_input and run the pipeline when new raw RCA files land
+_stop_service = threading.Event()
+
+
+def rca_input_signature():
+    # Name and ETag of every file waiting in RCA_input. The listing carries no file
+    # content, and the ETag changes whenever a file is replaced.
+    files = list_sharepoint_files(sharepoint_input_folder, properties=('Name', 'ETag'))
+    return frozenset((file.properties['Name'], file.properties.get('ETag')) for file in files)
+
+
+def warm_up_clients():
+    # Open the pooled clients once, so runs do not pay for the handshakes
+    get_http_session()
+    get_github_session()
+    get_sharepoint_context()
+    try:
+        get_mongo_client().admin.command('ping')
+    except Exception as e:
+        print(f'MongoDB is not reachable yet: {e}')
+
+
+def serve(interval=None, max_backoff=None):
+    # Long running mode. RCA_input is polled every interval seconds and the pipeline runs
+    # only when its listing differs from the one the last successful run started from.
+    # Failed polls and runs are retried with a doubling delay, capped at max_backoff; a
+    # failed run is resumed by the checkpointed runner on the next attempt.
+    load_config()
+    interval = service_poll_interval if interval is None else interval
+    max_backoff = service_max_backoff if max_backoff is None else max_backoff
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *args: _stop_service.set())
+    warm_up_clients()
+
+    processed_signature = None
+    retry_failed_run = False
+    delay = interval
+    print(f'Watching {sharepoint_input_folder} every {interval}s')
+    while not _stop_service.is_set():
         try:
-            os.remove(del_file)
-            print(f"Processed RCA file deleted successfully.")
-        except FileNotFoundError:
-            print(f"File '{del_file}' not found.")
-        except PermissionError:
-            print(f"Permission denied. Unable to delete file '{del_file}'.")
+            signature = rca_input_signature()
+            if signature and (signature != processed_signature or retry_failed_run):
+                print(f'{len(signature)} raw RCA file(s) waiting, starting a run')
+                retry_failed_run = True
+                main()
+                processed_signature = signature
+                retry_failed_run = False
+            delay = interval
         except Exception as e:
-            print(f"An error occurred while deleting the file: {e}")
+            delay = min(delay * 2, max_backoff)
+            print(f'An error occurred in the service loop: {e}; retrying in {delay}s')
+        _stop_service.wait(delay)
+    print('Service stopped')
+
+
+# Stages that can be run on their own from the command line, with their default inputs
+STAGE_COMMANDS = {
+    'retrieve_rca_from_sharepoint': retrieve_rca_from_sharepoint,
+    'get_recent_date': get_recent_date,
+    'download_database': lambda: download_database(raw_url),
+    'download_legacy_database': lambda: download_legacy_database(leg_url),
+    'fetch_sources': fetch_sources,
+    'transform_file': transform_file,
+    'update_legacy': update_legacy,
+    'connect_and_update_database': connect_and_update_database,
+    'finalize_database': lambda: [finalize_database(path) for path in (local_db_path, legacy_db_path)],
+    'load_to_github': load_to_github,
+    'load_legacy_to_github': load_legacy_to_github,
+    'load_databases_to_github': load_databases_to_github,
+    'move_raw_rca_to_archive': move_raw_rca_to_archive,
+}
+
+
+def show_history(as_of, terminal_id=None, db_path=None, output=None):
+    if terminal_id:
+        result = terminal_history(terminal_id, db_path)
+    else:
+        result = state_as_of(as_of, db_path)
+        print(f"{len(result)} terminals as of {as_of}: {result['STATUS'].value_counts().to_dict()}")
+    if output:
+        result.to_csv(output, index=False)
+        print(f'Written to {output}')
+    elif terminal_id:
+        print(result.to_string(index=False))
+
+
+def run_single_stage(name):
+    started_at = datetime.now()
+    try:
+        STAGE_COMMANDS[name]()
+    finally:
+        write_run_report(started_at)
+
+
+def cli(argv=None):
+    parser = argparse.ArgumentParser(description='Update the RCA databases from the raw RCA file on SharePoint.')
+    parser.add_argument('--config', help='path of credentials.json (default: next to this script)')
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('run', help='run the whole pipeline (the default)')
+    commands.add_parser('serve', help='poll RCA_input and run the pipeline when new files land')
+    commands.add_parser('rebuild-date-cache', help='rebuild the latest date cache from a full aggregation')
+    commands.add_parser('check-date-cache', help='compare the latest date cache with a full aggregation')
+    history_parser = commands.add_parser('history', help='terminal states as of a date, from the RCA_history change log')
+    history_parser.add_argument('as_of', nargs='?', type=date.fromisoformat, default=date.today(),
+                                help='date (YYYY-MM-DD) to report the states as of (default: today)')
+    history_parser.add_argument('--terminal', help='list every recorded change of this terminal instead')
+    history_parser.add_argument('--db', help='database holding the change log (default: LOCAL_DB)')
+    history_parser.add_argument('--output', help='write the states to this csv file')
+    stage_parser = commands.add_parser('stage', help='run one stage on its own')
+    stage_parser.add_argument('name', choices=list(STAGE_COMMANDS))
+    args = parser.parse_args(argv)
+
+    load_config(args.config)
+    if args.command == 'serve':
+        serve()
+    elif args.command == 'rebuild-date-cache':
+        rebuild_date_cache()
+    elif args.command == 'check-date-cache':
+        check_date_cache()
+    elif args.command == 'history':
+        show_history(args.as_of, args.terminal, args.db, args.output)
+    elif args.command == 'stage':
+        run_single_stage(args.name)
+    else:
+        main()
 
-def main():
-    retrieve_rca_from_sharepoint()
-    transform_file()
-    update_legacy()
-    connect_and_update_database()
-    load_to_github()
-    load_legacy_to_github()
-    move_raw_rca_to_archive()
-    clean_data()
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    cli()